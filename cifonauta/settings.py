@@ -176,6 +176,30 @@ ADMIN_MEDIA_PREFIX = '/static/admin/'
 # Increase limit for fields
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 15000
 
+# Cache shared by all server processes. Cached data is invalidated by version
+# counters bumped on changes (see cache_version in meta/models.py).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/cifonauta_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Version counters, kept apart so that culling cached data never drops
+    # them (there are only a few keys).
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/cifonauta_versions',
+    },
+}
+
+# Resolve search filters with an in-memory index of public media
+# (meta/bitmaps.py). Uses memory in each process, proportional to the number
+# of media and their metadata links. Built in a background thread of each
+# process; searches use the database until it is ready.
+MEDIA_BITMAP_INDEX = False
+
 # Required for debug_toolbar
 INTERNAL_IPS = ['127.0.0.1']
 
@@ -12,6 +12,17 @@ class MediaAdmin(TranslationAdmin):
     list_display = ('filepath', 'is_public', 'highlight', 'title', 'caption', 'timestamp')
     list_filter = ('is_public', 'highlight', 'timestamp', 'person', 'tag', 'taxon')
 
+    def save_related(self, request, form, formsets, change):
+        '''Refresh counters of previous and current taxa of the media.
+
+        Cached search counts are invalidated as well.
+        '''
+        taxa = set(form.instance.taxon_set.values_list('id', flat=True))
+        super().save_related(request, form, formsets, change)
+        taxa.update(form.instance.taxon_set.values_list('id', flat=True))
+        TaxonStats.refresh(taxa)
+        bump_cache_version('media')
+
 
 class TagAdmin(TranslationAdmin):
     filter_horizontal = ('media',)
@@ -41,6 +52,18 @@ class PersonAdmin(admin.ModelAdmin):
 class TaxonAdmin(admin.ModelAdmin):
     filter_horizontal = ('media',)
 
+    def save_related(self, request, form, formsets, change):
+        '''Refresh counters of the taxon, its ancestors and previous ancestors.
+
+        Lineages of the taxon and its descendants are rebuilt as well.
+        '''
+        super().save_related(request, form, formsets, change)
+        taxa = [form.instance.id]
+        if form.initial.get('parent'):
+            taxa.append(form.initial['parent'])
+        TaxonStats.refresh(taxa)
+        Taxon.refresh_lineage([form.instance.id])
+
 
 class ReferenceAdmin(admin.ModelAdmin):
     filter_horizontal = ('media',)
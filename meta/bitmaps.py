@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+'''In-memory index of public media for search filters.
+
+Keeps the sorted ids of public media for each metadata value, so that
+combinations of filters are resolved in memory instead of with joins. Id
+lists are arrays of 4-byte integers, so memory is proportional to the number
+of media links, and are intersected by bisection when one side is much
+smaller than the other. The values of each media are also kept (a forward
+index), to count the facets of small results.
+
+Public media are also kept in random key order, so pages of the random
+ordering are picked from the index and only their media are fetched.
+
+The index is optional (settings.MEDIA_BITMAP_INDEX) and kept by each process.
+It is built on first use and rebuilt when the media or taxonomy cache
+versions change (imports, media links edited in the admin, taxa updates).
+Builds run in a background thread; meanwhile requests are resolved by the
+database, so no request waits for a build or is served a stale index.
+'''
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from itertools import chain
+
+from django.conf import settings
+from django.db import connection
+
+from meta.models import Media, Taxon, cache_version
+
+
+# Query parameters and media fields indexed.
+M2M_FIELDS = (
+        ('author', 'person'),
+        ('tag', 'tag'),
+        ('taxon', 'taxon'),
+        ('reference', 'reference'),
+        )
+FK_FIELDS = (
+        ('location', 'location'),
+        ('city', 'city'),
+        ('state', 'state'),
+        ('country', 'country'),
+        )
+
+# Size ratio above which the smaller side is walked item by item (bisection,
+# forward index) instead of hashing or masking the larger one.
+SPARSE_RATIO = 16
+
+
+def id_array(ids):
+    '''Return sorted array of unique ids.'''
+    return array('I', sorted(set(ids)))
+
+
+def contains(ids, id):
+    '''Return whether a sorted array holds an id.'''
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+def intersect(a, b):
+    '''Return sorted array of ids present in both sorted arrays.'''
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) * SPARSE_RATIO < len(b):
+        return array('I', [id for id in a if contains(b, id)])
+    return id_array(set(a).intersection(b))
+
+
+def union(arrays):
+    '''Return sorted array of ids present in any of the sorted arrays.'''
+    if len(arrays) == 1:
+        return arrays[0]
+    return id_array(set().union(*arrays))
+
+
+class MediaIndex:
+    '''Sorted ids of public media per metadata value.'''
+
+    _instance = None
+    _building = False
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.version = self.current_version()
+        self.public = array('I')
+        self.datatype = {}
+        self.highlight = array('I')
+        self.values = {}
+        self.forward = {}
+        self.random_keys = array('d')
+        self.random_ids = array('I')
+        self.random_key = array('d')
+        self.trees = defaultdict(list)
+        self.intervals = {}
+        self.build()
+
+    @staticmethod
+    def current_version():
+        '''Return versions of the cached data the index is built from.'''
+        return (cache_version('media'), cache_version('taxonomy'))
+
+    @classmethod
+    def get(cls):
+        '''Return current index, or None if disabled or not built yet.
+
+        An outdated index starts a build in the background and is not used.
+        '''
+        if not getattr(settings, 'MEDIA_BITMAP_INDEX', False):
+            return None
+        instance = cls._instance
+        if instance is not None and instance.version == cls.current_version():
+            return instance
+        with cls._lock:
+            if not cls._building:
+                cls._building = True
+                threading.Thread(target=cls.warm, daemon=True).start()
+        return None
+
+    @classmethod
+    def warm(cls):
+        '''Build the index of current media and make it available.'''
+        try:
+            cls._instance = cls()
+        finally:
+            cls._building = False
+            # The thread has its own database connection.
+            connection.close()
+
+    def build(self):
+        '''Load ids from media table and metadata through tables.'''
+        datatype = defaultdict(list)
+        highlight = []
+        values = {param: defaultdict(list) for param, field in M2M_FIELDS + FK_FIELDS}
+        shuffled = []
+
+        public = Media.objects.filter(is_public=True).order_by('id')
+        fields = ['id', 'datatype', 'highlight', 'random_key'] + [
+                field for param, field in FK_FIELDS]
+        for row in public.values_list(*fields).iterator():
+            id = row[0]
+            self.public.append(id)
+            datatype[row[1]].append(id)
+            if row[2]:
+                highlight.append(id)
+            shuffled.append((row[3], id))
+            for (param, field), value in zip(FK_FIELDS, row[4:]):
+                if value:
+                    values[param][value].append(id)
+
+        for param, field in M2M_FIELDS:
+            through = Media._meta.get_field(field).through
+            links = through.objects.filter(media__is_public=True).values_list(field, 'media')
+            for value, media in links.iterator():
+                values[param][value].append(media)
+
+        self.datatype = {key: array('I', ids) for key, ids in datatype.items()}
+        self.highlight = array('I', highlight)
+        self.values = {param: {value: id_array(ids) for value, ids in ids_by_value.items()}
+                       for param, ids_by_value in values.items()}
+
+        # Random order of the random key index, and random key by media id.
+        shuffled.sort()
+        self.random_keys = array('d', [key for key, id in shuffled])
+        self.random_ids = array('I', [id for key, id in shuffled])
+        self.random_key = array('d', [0]) * (self.public[-1] + 1 if self.public else 0)
+        for key, id in shuffled:
+            self.random_key[id] = key
+
+        # Values of media id n are linked[offsets[n]:offsets[n + 1]].
+        for param, ids_by_value in self.values.items():
+            links = sorted((id, value) for value, ids in ids_by_value.items() for id in ids)
+            offsets = array('I', [0]) * (len(self.random_key) + 1)
+            for id, value in links:
+                offsets[id + 1] += 1
+            for id in range(len(self.random_key)):
+                offsets[id + 1] += offsets[id]
+            self.forward[param] = (offsets, array('I', [value for id, value in links]))
+
+        # Taxa ordered by tree and left value to find subtrees by bisection.
+        for id, tree_id, lft, rght in Taxon.objects.order_by(
+                'tree_id', 'lft').values_list('id', 'tree_id', 'lft', 'rght'):
+            self.trees[tree_id].append((lft, id))
+            self.intervals[id] = (tree_id, lft, rght)
+
+    def taxon(self, id):
+        '''Return ids of media of a taxon and its descendants.'''
+        if id not in self.intervals:
+            return array('I')
+        tree_id, lft, rght = self.intervals[id]
+        nodes = self.trees[tree_id]
+        start = bisect_left(nodes, (lft, 0))
+        end = bisect_right(nodes, (rght, float('inf')))
+        ids = self.values['taxon']
+        arrays = [ids[node] for lft, node in nodes[start:end] if node in ids]
+        return union(arrays) if arrays else array('I')
+
+    def parse(self, query_dict):
+        '''Return {param: ids} of the metadata values in query_dict.'''
+        filters = {}
+        for param, field in M2M_FIELDS + FK_FIELDS:
+            ids = set()
+            for value in query_dict.getlist(param):
+                try:
+                    ids.add(int(value))
+                except ValueError:
+                    continue
+            if ids:
+                filters[param] = ids
+        return filters
+
+    def filter(self, query_dict, operator, exclude=None):
+        '''Return sorted ids of public media matching the search parameters.
+
+        Uses datatype, highlight and metadata parameters like compile_filters
+        in views: fields combined with AND, values with the operator, without
+        the exclude parameter. Returns None when nothing is filtered (i.e.,
+        all public media).
+        '''
+        filtered = []
+        datatype = query_dict.get('datatype', 'all')
+        if datatype != 'all':
+            filtered.append(self.datatype.get(datatype, array('I')))
+        if query_dict.get('highlight', False):
+            filtered.append(self.highlight)
+        for param, ids in self.parse(query_dict).items():
+            if param == exclude:
+                continue
+            if param == 'taxon':
+                arrays = [self.taxon(id) for id in ids]
+            else:
+                arrays = [self.values[param].get(id, array('I')) for id in ids]
+            if operator == 'and':
+                filtered.extend(arrays)
+            else:
+                filtered.append(union(arrays))
+        if not filtered:
+            return None
+        # Intersect from the smallest list, so later steps can bisect.
+        filtered.sort(key=len)
+        ids = filtered[0]
+        for other in filtered[1:]:
+            ids = intersect(ids, other)
+        return ids
+
+    def count(self, ids):
+        '''Return number of media in filtered ids (None for all public).'''
+        return len(self.public if ids is None else ids)
+
+    def facets(self, query_dict, operator, params):
+        '''Return {id: count} of matching media for each parameter.
+
+        With the 'or' operator the values of a parameter are counted without
+        its own filter (disjunctive facets), like facet_counts in views.
+
+        Small results count the values of each media in the forward index.
+        Large ones look the ids of each value up in a mask of the results.
+        '''
+        filtered = self.parse(query_dict)
+        results = {None: self.filter(query_dict, operator)}
+        masks = {}
+        facets = {}
+        for param in params:
+            exclude = param if operator == 'or' and param in filtered else None
+            if exclude not in results:
+                results[exclude] = self.filter(query_dict, operator, exclude)
+            ids = results[exclude]
+            values = self.values[param]
+            if ids is None:
+                facets[param] = {value: len(value_ids) for value, value_ids in values.items()}
+                continue
+            offsets, linked = self.forward[param]
+            if len(ids) * SPARSE_RATIO < len(linked):
+                facets[param] = dict(Counter(chain.from_iterable(
+                        [linked[offsets[id]:offsets[id + 1]] for id in ids])))
+                continue
+            mask = masks.get(exclude)
+            if mask is None:
+                mask = masks[exclude] = bytearray(len(self.random_key))
+                for id in ids:
+                    mask[id] = 1
+            counts = {}
+            for value, value_ids in values.items():
+                count = sum(map(mask.__getitem__, value_ids))
+                if count:
+                    counts[value] = count
+            facets[param] = counts
+        return facets
+
+    def walk(self, ids, pivot, values=None, backward=False, start=0, size=1):
+        '''Return ids of filtered media in random order, like ShuffledPaginator.
+
+        Media are walked in random key order from the pivot to the end and
+        then from the start to the pivot, after (or before) the cursor values
+        (random_key, id), skipping start media. Large results are walked in
+        the order of all public media; small ones are sorted by random key.
+        '''
+        if ids is None or len(ids) * SPARSE_RATIO > len(self.random_ids):
+            keys, order = self.random_keys, self.random_ids
+            check = ids is not None
+        else:
+            shuffled = sorted((self.random_key[id], id) for id in ids)
+            keys = [key for key, id in shuffled]
+            order = [id for key, id in shuffled]
+            check = False
+        n = len(order)
+        first = bisect_left(keys, pivot)
+
+        # Position of the cursor in the walk, from the pivot.
+        position = 0
+        if values:
+            key, id = values
+            i = bisect_left(keys, key)
+            while i < n and keys[i] == key and order[i] < id:
+                i += 1
+            found = i < n and keys[i] == key and order[i] == id
+            position = i - first if key >= pivot else i + n - first
+            if not backward and found:
+                position += 1
+        positions = range(position - 1, -1, -1) if backward else range(position, n)
+
+        page = []
+        for position in positions:
+            id = order[(first + position) % n]
+            if check and not contains(ids, id):
+                continue
+            if start:
+                start -= 1
+                continue
+            page.append(id)
+            if len(page) >= size:
+                break
+        return page
@@ -37,6 +37,7 @@ ORDER_BY = (
         ('pub_date', _('data de publicação')),
         ('timestamp', _('data de modificação')),
         ('random', _('aleatório')),
+        ('rank', _('relevância')),
         )
 
 DATATYPES = (
@@ -108,6 +109,20 @@ class DisplayForm(forms.Form):
             # widget=forms.CheckboxSelectMultiple(), required=False,
             # label=_('Táxons'))
 
+    def set_facets(self, facets):
+        '''Show number of results for each choice of the metadata fields.
+
+        facets maps field names to {id: count}. Choices without results are
+        hidden, unless already selected.
+        '''
+        for name, counts in facets.items():
+            field = self.fields[name]
+            selected = [id for id in self.data.get(name, []) if str(id).isdigit()]
+            field.queryset = field.queryset.filter(
+                    Q(id__in=counts.keys()) | Q(id__in=selected))
+            field.label_from_instance = lambda obj, counts=counts: \
+                    '{} ({})'.format(obj, counts.get(obj.id, 0))
+
 
 class AdminForm(forms.Form):
     '''Seleciona destaques e inclui imagens em tours.'''
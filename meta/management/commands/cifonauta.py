@@ -2,6 +2,7 @@ import os
 import pickle
 import time
 
+from collections import Counter
 from optparse import make_option
 from datetime import datetime
 from django.core.management.base import BaseCommand, CommandError
@@ -11,7 +12,7 @@ from django.utils import timezone
 from cifonauta.settings import BASE_DIR, SOURCE_ROOT, MEDIA_ROOT, PHOTO_EXTENSIONS, VIDEO_EXTENSIONS, MEDIA_EXTENSIONS
 from media_utils import *
 from meta import models
-from worms import Aphia
+from worms import Aphia, NameIndex
 
 
 class Command(BaseCommand):
@@ -28,6 +29,9 @@ class Command(BaseCommand):
         parser.add_argument('-m', '--only-movies', action='store_true',
                         dest='videos', default=False,
                         help='Only scan videos.')
+        parser.add_argument('-r', '--recount', action='store_true',
+                        dest='recount', default=False,
+                        help='Recount public media stats instead of updating them.')
 
     def handle(self, *args, **options):
         '''Command execution trunk.'''
@@ -59,7 +63,10 @@ class Command(BaseCommand):
 
         self.stdout.write('\nProcessing {} file(s)...'.format(n_max))
 
-        # Process files in source_media.
+        # Files that need to be created or updated.
+        pending = []
+
+        # Read metadata from files in source_media.
         for src_file in source_media.files[:n_max]:
             # Search database.
             record, modified = cbm.search_db(src_file)
@@ -68,20 +75,31 @@ class Command(BaseCommand):
                 self.stdout.write('\nENTRY UP-TO-DATE! NEXT...')
             # Entry exists and timestamps differ.
             elif record and modified:
-                self.stdout.write('\nUPDATING ENTRY...')
                 src_file.create_meta(record)
-                cbm.update_db(src_file, update=True)
-                self.stdout.write('\nPROCESSING MEDIA...')
-                src_file.process_media()
-                n_updated += 1
+                pending.append((src_file, True))
             # Entry does not exits in the database.
             elif not record:
                 self.stdout.write('NEW FILE!')
                 src_file.create_meta()
+                pending.append((src_file, False))
+
+        # Resolve unknown taxa at once before updating the database.
+        cbm.resolve_taxa([taxon for src_file, update in pending
+                          for taxon in src_file.metadata.taxon])
+
+        # Process pending files. New taxa are created as roots (their parents
+        # come from update_taxa), so no tree is shifted here.
+        for src_file, update in pending:
+            if update:
+                self.stdout.write('\nUPDATING ENTRY...')
+                cbm.update_db(src_file, update=True)
+                n_updated += 1
+            else:
+                self.stdout.write('\nCREATING ENTRY...')
                 cbm.update_db(src_file)
-                self.stdout.write('\nPROCESSING MEDIA...')
-                src_file.process_media()
                 n_new += 1
+            self.stdout.write('\nPROCESSING MEDIA...')
+            src_file.process_media()
 
         # Number of files analyzed.
         n = len(source_media.files[:n_max])
@@ -94,7 +112,20 @@ class Command(BaseCommand):
 
         # Database statistics.
         self.stdout.write('\nDATABASE STATS')
-        cbm.update_stats()
+        cbm.update_stats(recount=options['recount'])
+
+        # Taxon media counters.
+        models.TaxonStats.refresh(cbm.changed_taxa)
+
+        # Taxon lineages, since new taxa may have been placed in the trees.
+        models.Taxon.refresh_lineage()
+
+        # Invalidate cached search counts.
+        models.bump_cache_version('media')
+
+        # Rebuild thumbnail pools of listing pages.
+        for field in ('tag', 'reference', 'tour'):
+            models.thumbnail_pool(field)
 
         # Running time.
         t = time.time() - t0
@@ -109,6 +140,12 @@ class Database:
     def __init__(self):
         # Set language to Portuguese.
         translation.activate('pt-br')
+        # Taxa with added or removed media, for refreshing counters.
+        self.changed_taxa = set()
+        # Changes in public media counts, for updating stats.
+        self.media_counts = Counter()
+        # Similar known names of unresolved taxa, offered when confirming them.
+        self.suggestions = {}
 
     def search_db(self, media):
         '''Query database for filename.
@@ -185,8 +222,10 @@ class Database:
         if not update:
             entry = models.Media(**media_meta)
             entry.save()
+            self.count_media(entry, 1)
         else:
             entry = models.Media.objects.get(filepath=media_meta['filepath'])
+            self.count_media(entry, -1)
             for k, v in media_meta.items():
                 setattr(entry, k, v)
 
@@ -196,8 +235,10 @@ class Database:
         # Update sources.
         entry = self.update_sets(entry, 'person', sources)
 
-        # Update taxa.
+        # Update taxa (keeping previous and current ones for counters).
+        self.changed_taxa.update(entry.taxon_set.values_list('id', flat=True))
         entry = self.update_sets(entry, 'taxon', taxa)
+        self.changed_taxa.update(entry.taxon_set.values_list('id', flat=True))
 
         # Update tags.
         entry = self.update_sets(entry, 'tag', tags)
@@ -207,9 +248,16 @@ class Database:
 
         # Saving modifications.
         entry.save()
+        if update:
+            self.count_media(entry, 1)
 
         print('Entry updated!')
 
+    def count_media(self, entry, n):
+        '''Add n to the public media count of the entry's type.'''
+        if entry.is_public:
+            self.media_counts[entry.datatype] += n
+
     def get_instance(self, table, value):
         '''Returns ID from name.'''
 
@@ -233,17 +281,14 @@ class Database:
                 model = empty_model.objects.get(name=value)
         except:
             # Load bad data dictionary.
-            try:
-                bad_data_file = open('bad_data.pkl', 'rb')
-                bad_data = pickle.load(bad_data_file)
-                bad_data_file.close()
-            except:
-                bad_data = {}
+            bad_data = self.load_bad_data()
             try:
                 fixed_value = bad_data[value]
                 print('  "{}" automatically fixed to "{}"'.format(value, bad_data[value]))
             except:
-                fixed_value = input('\n     Press enter to confirm OR type the correct value: ') or value
+                default = self.suggestions.get(value, value) if table == 'taxon' else value
+                fixed_value = input('\n     Press enter to confirm "{}" OR type the correct value: '.format(
+                    default)) or default
             try:
                 if table == 'author':
                     empty_model = getattr(models, 'person'.capitalize())
@@ -257,16 +302,14 @@ class Database:
                     print('     > "{}" already existed!\n'.format(fixed_value))
                     # Add to bad data dictionary.
                     bad_data[value] = fixed_value
-                    bad_data_file = open('bad_data.pkl', 'wb')
-                    pickle.dump(bad_data, bad_data_file)
-                    bad_data_file.close()
+                    self.save_bad_data(bad_data)
                 # TODO Fix metadata field on original image!!!
             except:
                 print('Object "{}" not found! Or auto-fix failed.'.format(fixed_value))
 
         # Check WoRMS for taxonomic info.
         if table == 'taxon' and new:
-            taxon = self.get_worms(value)
+            taxon = self.get_worms(fixed_value)
             if taxon:
                 model = taxon
         return model
@@ -282,11 +325,8 @@ class Database:
             if field == 'author':
                 field = 'person'
             meta_set = getattr(entry, field + '_set')
-            meta_set.clear()
-            # Add updated values to set.
-            if meta_instances:
-                for value in meta_instances:
-                    meta_set.add(value)
+            # Replace set with updated values at once.
+            meta_set.set(meta_instances)
         return entry
 
     def get_worms(self, name):
@@ -299,18 +339,88 @@ class Database:
             taxon.aphia = record['AphiaID']
             taxon.timestamp = timezone.now()
             taxon.save()
+            return taxon
         else:
             return None
 
-    def update_stats(self):
-        '''Updates site wide statistics.'''
+    def resolve_taxa(self, names):
+        '''Find valid names for unknown taxa before importing.
+
+        Known and previously fixed names are skipped. Names one typo away from
+        a single known taxon name (or taxon fix) are resolved locally. The
+        remaining unknowns are sent to WoRMS for fuzzy matching, in batches of
+        50 names. Fixes are stored in the bad data dictionary used by
+        get_instance(); similar local names WoRMS could not confirm are offered
+        there as the default.
+        '''
+        bad_data = self.load_bad_data()
+        names = set(names)
+        index = NameIndex(models.Taxon.objects.values_list('name', flat=True))
+        index.update(bad_data[name] for name in names if name in bad_data)
+
+        unknown = []
+        for name in sorted(names):
+            if name in index.names or name in bad_data:
+                continue
+            match = index.resolve(name)
+            if match:
+                print('  "{}" matched locally to "{}"'.format(name, match))
+                bad_data[name] = match
+            else:
+                unknown.append(name)
+
+        if unknown:
+            print('\nWORMS: matching {} unknown taxa...'.format(len(unknown)))
+            aphia = Aphia()
+            matches = aphia.match_names(unknown)
+            for name in unknown:
+                record = matches.get(name)
+                if record:
+                    if record['scientificname'] != name:
+                        print('  "{}" matched in WoRMS to "{}"'.format(
+                            name, record['scientificname']))
+                        bad_data[name] = record['scientificname']
+                    continue
+                match = index.match(name)
+                if match:
+                    self.suggestions[name] = match
+
+        self.save_bad_data(bad_data)
+
+    def load_bad_data(self):
+        '''Load dictionary with fixes for bad metadata values.'''
+        try:
+            bad_data_file = open('bad_data.pkl', 'rb')
+            bad_data = pickle.load(bad_data_file)
+            bad_data_file.close()
+        except:
+            bad_data = {}
+        return bad_data
+
+    def save_bad_data(self, bad_data):
+        '''Save dictionary with fixes for bad metadata values.'''
+        bad_data_file = open('bad_data.pkl', 'wb')
+        pickle.dump(bad_data, bad_data_file)
+        bad_data_file.close()
+
+    def update_stats(self, recount=False):
+        '''Updates site wide statistics.
+
+        Media counts are updated with the media changed by this import, or
+        recounted if recount is True. Tags, locations and species are always
+        recounted, since they also change outside imports (taxa updates, admin).
+        '''
 
         # Get main stats object
         cifo = models.Stats.objects.get(site='cifonauta')
 
         # Updates values
-        cifo.photos = models.Media.objects.filter(is_public=True, datatype='photo').count()
-        cifo.videos = models.Media.objects.filter(is_public=True, datatype='video').count()
+        if recount:
+            cifo.photos = models.Media.objects.filter(is_public=True, datatype='photo').count()
+            cifo.videos = models.Media.objects.filter(is_public=True, datatype='video').count()
+        else:
+            cifo.photos += self.media_counts['photo']
+            cifo.videos += self.media_counts['video']
         cifo.tags = models.Tag.objects.count()
         cifo.species = models.Taxon.objects.filter(rank_en='Species').count()
         cifo.locations = models.Location.objects.count()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
-from django.core.management.base import BaseCommand
+from datetime import datetime, time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
 from django.template.defaultfilters import slugify
-from meta.models import Image, Video, Taxon
-from worms import Aphia
+from meta.models import Media, Taxon, TaxonStats, Stats
+from worms import Aphia, WormsError
 
 '''
 Example Aphia record:
@@ -39,18 +42,70 @@ Example Aphia record:
 
 
 class Command(BaseCommand):
-    help = 'Translate rank names in batch.'
+    help = 'Update taxa with valid records from WoRMS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--incremental', action='store_true',
+                        dest='incremental', default=False,
+                        help='Only update taxa modified in WoRMS since the last sync.')
+        parser.add_argument('-s', '--since', action='store',
+                        dest='since', default=None,
+                        help='Start date for the incremental sync (YYYY-MM-DD).')
 
     def handle(self, *args, **options):
 
+        # Start of this sync, saved as the next watermark.
+        started = timezone.now()
+
+        # Get main stats object, which keeps the last sync date.
+        cifo = Stats.objects.get(site='cifonauta')
+
+        if options['incremental']:
+            if options['since']:
+                try:
+                    since = parse_datetime(options['since'])
+                    if not since:
+                        since = datetime.combine(parse_date(options['since']), time.min)
+                except (ValueError, TypeError):
+                    raise CommandError('Invalid date: {}'.format(options['since']))
+                if timezone.is_naive(since):
+                    since = timezone.make_aware(since)
+            else:
+                since = cifo.taxa_sync
+            if not since:
+                raise CommandError('No previous sync found. Run a full update or use --since.')
+            self.update_modified(since, started)
+        else:
+            self.update_all()
+
+        # Save sync watermark and the species count, which changes with
+        # new taxa and ranks.
+        cifo.taxa_sync = started
+        cifo.species = Taxon.objects.filter(rank_en='Species').count()
+        cifo.save()
+
+        self.stdout.write('\nTaxonomic trees rebuilt.')
+
+        # Recount media, since taxa may have moved between clades.
+        TaxonStats.refresh()
+        self.stdout.write('Taxon counters refreshed.')
+
+        # Rebuild lineages of moved or renamed taxa.
+        Taxon.refresh_lineage()
+        self.stdout.write('Taxon lineages refreshed.')
+
+    def update_all(self):
+        '''Search WoRMS for every taxon associated with media.'''
+
         # Get all taxa.
         media = Media.objects.all()
-        taxa = Taxon.objects.all()
 
         # All media taxa.
-        all_taxa = list(media.values_list('taxon__name', flat=True))
+        all_taxa = list(media.order_by().values_list('taxon__name', flat=True).distinct())
         print(all_taxa)
 
+        # Search WoRMS first, outside of the transaction.
+        records = {}
         for taxon_name in all_taxa:
             if taxon_name:
                 self.stdout.write('\nInitiating search on: {}'.format(taxon_name))
@@ -62,13 +117,66 @@ class Command(BaseCommand):
                         record['rank'],
                         record['status'])
                         )
-                    # Get model.
-                    taxon = Taxon.objects.get(name=taxon_name)
-                    # Update it with the new information.
-                    update_model(taxon, record)
-                    self.stdout.write('Saved!')
+                    records[taxon_name] = record
                 else:
                     self.stdout.write('No record in WoRMS: {}'.format(taxon_name))
+        parent_records = search_parents(records.values())
+
+        # Save records at once. MPTT updates are delayed and only the modified
+        # trees are rebuilt at the end.
+        with transaction.atomic():
+            with Taxon.objects.delay_mptt_updates():
+                for taxon in Taxon.objects.filter(name__in=records.keys()):
+                    # Update it with the new information.
+                    update_model(taxon, records[taxon.name], parent_records)
+                    self.stdout.write('Saved: {}'.format(taxon.name))
+
+    def update_modified(self, since, until):
+        '''Update only taxa whose WoRMS records changed between two dates.
+
+        Moving a taxon to a new parent carries its whole subtree along, so
+        descendants do not need to be searched again.
+        '''
+        self.stdout.write('\nSearching WoRMS records modified since {}'.format(since))
+
+        # AphiaIDs of local taxa.
+        local_ids = set(Taxon.objects.exclude(aphia=None).values_list('aphia', flat=True))
+
+        # Keep only records of local taxa. All pages must be read before the
+        # sync date is saved, so a failure aborts the command.
+        aphia = Aphia()
+        modified = {}
+        try:
+            for record in aphia.iter_aphia_records_by_date(since.isoformat(), until.isoformat()):
+                if record['AphiaID'] in local_ids:
+                    modified[record['AphiaID']] = record
+        except WormsError as error:
+            raise CommandError('{} Sync date not updated.'.format(error))
+
+        self.stdout.write('{} local taxa modified in WoRMS.'.format(len(modified)))
+
+        # Follow synonyms to the valid records, outside of the transaction.
+        records = {}
+        for aphia_id, record in modified.items():
+            record = aphia.select_valid([record])
+            if record:
+                self.stdout.write('\nModified record: {0} ({1}) -- {2}'.format(
+                    record['scientificname'],
+                    record['rank'],
+                    record['status'])
+                    )
+                records[aphia_id] = record
+            else:
+                self.stdout.write('No valid record in WoRMS: {}'.format(aphia_id))
+        parent_records = search_parents(records.values())
+
+        # Save records at once. MPTT updates are delayed and only the modified
+        # trees are rebuilt at the end.
+        with transaction.atomic():
+            with Taxon.objects.delay_mptt_updates():
+                for taxon in Taxon.objects.filter(aphia__in=records.keys()):
+                    update_model(taxon, records[taxon.aphia], parent_records)
+                    self.stdout.write('Saved: {}'.format(taxon.name))
 
 #            if taxon.rank_pt_br and taxon.rank_en:
 #                continue
@@ -82,8 +190,44 @@ class Command(BaseCommand):
 #        self.stdout.write('Finished translation.')
 #
 #
-def update_model(taxon, record):
-    '''Updates database entry.'''
+def parent_names(record):
+    '''Return names and ranks of the parents of a record, lowest first.'''
+    parents = [
+            {'name': record['genus'], 'rank': 'Genus'},
+            {'name': record['family'], 'rank': 'Family'},
+            {'name': record['order'], 'rank': 'Order'},
+            {'name': record['cls'], 'rank': 'Class'},
+            {'name': record['phylum'], 'rank': 'Phylum'},
+            {'name': record['kingdom'], 'rank': 'Kingdom'},
+            ]
+    return [parent for parent in parents
+            if parent['name'] and not parent['name'] == record['scientificname']]
+
+
+def search_parents(records):
+    '''Search WoRMS for the parents of records that need an update.
+
+    Only new parents or parents last updated more than a week ago are
+    searched. Returns a dictionary with each name and its record (or None).
+    '''
+    today = timezone.now()
+    names = {parent['name'] for record in records for parent in parent_names(record)}
+    timestamps = dict(Taxon.objects.filter(name__in=names).values_list('name', 'timestamp'))
+    parent_records = {}
+    for name in sorted(names):
+        timestamp = timestamps.get(name)
+        if name in timestamps and timestamp and (today - timestamp).days <= 7:
+            continue
+        parent_records[name] = search_worms(name)
+    return parent_records
+
+
+def update_model(taxon, record, parent_records):
+    '''Updates database entry.
+
+    Parents are updated with the records found by search_parents(). Parents
+    without a record keep their data.
+    '''
     today = timezone.now()
     taxon.name = record['scientificname']
     taxon.slug = slugify(record['scientificname'])
@@ -97,33 +241,22 @@ def update_model(taxon, record):
     instances = [taxon]
 
     # Get parents' instances.
-    parents = [
-            {'name': record['genus'], 'rank': 'Genus'},
-            {'name': record['family'], 'rank': 'Family'},
-            {'name': record['order'], 'rank': 'Order'},
-            {'name': record['cls'], 'rank': 'Class'},
-            {'name': record['phylum'], 'rank': 'Phylum'},
-            {'name': record['kingdom'], 'rank': 'Kingdom'},
-            ]
-    for parent in parents:
-        if parent['name'] and not parent['name'] == record['scientificname']:
-            # Get instance first.
-            parent_instance, new = Taxon.objects.get_or_create(name=parent['name'])
-            # Only search WoRMS if last update was > a week ago.
-            if parent_instance.timestamp:
-                difference = today - parent_instance.timestamp
-                delta_days = difference.days
-            else:
-                delta_days = 10
-            if new or delta_days > 7:
-                parent_record = search_worms(parent['name'])
-                parent_instance.name = parent_record['scientificname']
-                parent_instance.rank_en = parent_record['rank']
-                parent_instance.rank_pt_br = translate_rank(parent_record['rank'])
-                parent_instance.aphia = parent_record['AphiaID']
-                parent_instance.timestamp = today
-                parent_instance.save()
-            instances.append(parent_instance)
+    for parent in parent_names(record):
+        # Get instance first.
+        parent_instance, new = Taxon.objects.get_or_create(name=parent['name'])
+        parent_record = parent_records.get(parent['name'])
+        if parent_record:
+            parent_instance.name = parent_record['scientificname']
+            parent_instance.rank_en = parent_record['rank']
+            parent_instance.rank_pt_br = translate_rank(parent_record['rank'])
+            parent_instance.aphia = parent_record['AphiaID']
+            parent_instance.timestamp = today
+            parent_instance.save()
+        elif new:
+            parent_instance.rank_en = parent['rank']
+            parent_instance.rank_pt_br = translate_rank(parent['rank'])
+            parent_instance.save()
+        instances.append(parent_instance)
 
     # Iterate through instances saving parents.
     previous = None
@@ -145,6 +278,7 @@ def search_worms(taxon_name):
     if not records:
         # TODO Elaborate search with fuzzy match_aphia_records_by_names.
         return None
+    valid = None
     for record in records:
         print(record)
         if record['status'] == 'accepted':
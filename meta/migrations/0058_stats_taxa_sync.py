@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0057_auto_20191201_1101'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stats',
+            name='taxa_sync',
+            field=models.DateTimeField(blank=True, help_text='Data da última sincronização dos táxons com o WoRMS.', null=True, verbose_name='sincronização dos táxons'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0058_stats_taxa_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxonStats',
+            fields=[
+                ('taxon', models.OneToOneField(help_text='Táxon destas estatísticas.', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='meta.Taxon', verbose_name='táxon')),
+                ('photos', models.PositiveIntegerField(default=0, help_text='Número de fotos públicas do táxon.')),
+                ('videos', models.PositiveIntegerField(default=0, help_text='Número de vídeos públicos do táxon.')),
+                ('private', models.PositiveIntegerField(default=0, help_text='Número de arquivos privados do táxon.')),
+                ('clade_photos', models.PositiveIntegerField(default=0, help_text='Número de fotos públicas do táxon e descendentes.')),
+                ('clade_videos', models.PositiveIntegerField(default=0, help_text='Número de vídeos públicos do táxon e descendentes.')),
+                ('clade_private', models.PositiveIntegerField(default=0, help_text='Número de arquivos privados do táxon e descendentes.')),
+            ],
+            options={
+                'verbose_name': 'estatísticas do táxon',
+                'verbose_name_plural': 'estatísticas dos táxons',
+            },
+        ),
+        migrations.RunSQL(
+            '''
+            INSERT INTO meta_taxonstats (taxon_id, photos, videos, private,
+                                         clade_photos, clade_videos, clade_private)
+            SELECT t.id,
+                COUNT(DISTINCT m.id) FILTER (WHERE d.id = t.id AND m.is_public AND m.datatype = 'photo'),
+                COUNT(DISTINCT m.id) FILTER (WHERE d.id = t.id AND m.is_public AND m.datatype = 'video'),
+                COUNT(DISTINCT m.id) FILTER (WHERE d.id = t.id AND NOT m.is_public),
+                COUNT(DISTINCT m.id) FILTER (WHERE m.is_public AND m.datatype = 'photo'),
+                COUNT(DISTINCT m.id) FILTER (WHERE m.is_public AND m.datatype = 'video'),
+                COUNT(DISTINCT m.id) FILTER (WHERE NOT m.is_public)
+            FROM meta_taxon t
+            LEFT JOIN meta_taxon d
+                ON d.tree_id = t.tree_id AND d.lft BETWEEN t.lft AND t.rght
+            LEFT JOIN meta_taxon_media tm ON tm.taxon_id = d.id
+            LEFT JOIN meta_media m ON m.id = tm.media_id
+            GROUP BY t.id
+            ''',
+            reverse_sql=migrations.RunSQL.noop),
+    ]
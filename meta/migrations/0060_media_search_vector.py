@@ -0,0 +1,44 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:02
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0059_taxonstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, help_text='Vetor de busca com texto e metadados do arquivo.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='meta_media_search_gin'),
+        ),
+        migrations.RunSQL(
+            '''
+            UPDATE meta_media m SET search_vector =
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE(m.title_pt_br, '')), 'A') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE(m.title_en, '')), 'A') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE(m.caption_pt_br, '')), 'A') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE(m.caption_en, '')), 'A') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT string_agg(x.name, ' ') FROM meta_person x JOIN meta_person_media xm ON xm.person_id = x.id WHERE xm.media_id = m.id), '')), 'B') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT string_agg(x.name_pt_br, ' ') FROM meta_tag x JOIN meta_tag_media xm ON xm.tag_id = x.id WHERE xm.media_id = m.id), '')), 'B') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT string_agg(x.name_en, ' ') FROM meta_tag x JOIN meta_tag_media xm ON xm.tag_id = x.id WHERE xm.media_id = m.id), '')), 'B') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT string_agg(x.name, ' ') FROM meta_taxon x JOIN meta_taxon_media xm ON xm.taxon_id = x.id WHERE xm.media_id = m.id), '')), 'B') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name FROM meta_location x WHERE x.id = m.location_id), '')), 'C') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name_pt_br FROM meta_city x WHERE x.id = m.city_id), '')), 'C') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name_en FROM meta_city x WHERE x.id = m.city_id), '')), 'C') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name_pt_br FROM meta_state x WHERE x.id = m.state_id), '')), 'C') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name_en FROM meta_state x WHERE x.id = m.state_id), '')), 'C') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name_pt_br FROM meta_country x WHERE x.id = m.country_id), '')), 'C') ||
+                setweight(to_tsvector('portuguese_unaccent'::regconfig, COALESCE((SELECT x.name_en FROM meta_country x WHERE x.id = m.country_id), '')), 'C')
+            ''',
+            reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:05
+
+from django.db import migrations, models
+import random
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0060_media_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='random_key',
+            field=models.FloatField(db_index=True, default=random.random, editable=False, help_text='Chave aleatória para amostragem.'),
+        ),
+        # The default is evaluated only once, give each row its own key.
+        migrations.RunSQL(
+            'UPDATE meta_media SET random_key = random();',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.13 on 2026-10-19 18:20
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+MAIN_RANKS = ['Reino', 'Filo', 'Classe', 'Ordem', 'Família', 'Gênero', 'Espécie',
+              'Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+# Fill lineages of taxa (t) with their main rank ancestors (a).
+LINEAGE_SQL = '''
+    UPDATE meta_taxon AS t SET lineage = l.lineage
+    FROM (
+        SELECT t.id, COALESCE(jsonb_agg(jsonb_build_object(
+                'id', a.id, 'name', a.name, 'slug', a.slug,
+                'rank_pt_br', a.rank_pt_br, 'rank_en', a.rank_en)
+                ORDER BY a.lft) FILTER (WHERE a.id IS NOT NULL), '[]') AS lineage
+        FROM meta_taxon t
+        LEFT JOIN meta_taxon a ON a.tree_id = t.tree_id AND a.lft < t.lft
+            AND a.rght > t.rght AND (a.rank_en = ANY(%s) OR a.rank_pt_br = ANY(%s))
+        GROUP BY t.id
+    ) AS l
+    WHERE t.id = l.id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta', '0061_media_random_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taxon',
+            name='lineage',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list, editable=False, help_text='Ancestrais de ranking principal do táxon (ver refresh_lineage).', verbose_name='linhagem'),
+        ),
+        migrations.RunSQL(
+            [(LINEAGE_SQL, [MAIN_RANKS, MAIN_RANKS])],
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,12 +1,40 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+import random
+import time
+
+from django.core.cache import cache, caches
+from django.core.exceptions import EmptyResultSet
+from django.db import models, connection, transaction
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from mptt.models import MPTTModel
 from meta.signals import *
 
-from django.db.models import Q
+from django.db.models import Q, F, OuterRef, Subquery, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+
+
+class MediaQuerySet(models.QuerySet):
+    '''Random access to media through the indexed random key.'''
+
+    def random(self, k=1):
+        '''Returns a list with k random media.
+
+        Reads the next k rows of the random key index from a random point,
+        wrapping around to the beginning when needed.
+        '''
+        pivot = random.random()
+        sample = list(self.filter(random_key__gte=pivot).order_by('random_key')[:k])
+        if len(sample) < k:
+            sample.extend(self.filter(random_key__lt=pivot).order_by(
+                'random_key')[:k - len(sample)])
+        return sample
 
 
 class Media(models.Model):
@@ -35,6 +63,8 @@ class Media(models.Model):
             help_text=_('Visível para visitantes.'))
     pub_date = models.DateTimeField(_('data de publicação'), auto_now_add=True,
             help_text=_('Data de publicação da imagem no Cifonauta.'))
+    random_key = models.FloatField(default=random.random, db_index=True,
+            editable=False, help_text=_('Chave aleatória para amostragem.'))
 
     # Metadata
     title = models.CharField(_('título'), max_length=200, default='',
@@ -72,16 +102,63 @@ class Media(models.Model):
             null=True, blank=True, verbose_name=_('país'),
             help_text=_('País mostrado na imagem (ou país de coleta).'))
 
+    # Search
+    search_vector = SearchVectorField(null=True, editable=False,
+            help_text=_('Vetor de busca com texto e metadados do arquivo.'))
+
+    objects = MediaQuerySet.as_manager()
+
     def __str__(self):
         return 'ID={} {} ({})'.format(self.id, self.title, self.datatype)
 
     def get_absolute_url(self):
         return reverse('media_url', args=[str(self.id)])
 
+    @staticmethod
+    def update_search_vector(queryset):
+        '''Updates the stored search vector of media in a queryset.
+
+        Titles and captions have weight A, authors, tags and taxa weight B, and
+        places weight C. Related names are collected with subqueries so the
+        whole queryset is updated in a single query.
+        '''
+        config = 'portuguese_unaccent'
+
+        def related_names(model, field):
+            '''Names of many to many metadata joined in a single string.'''
+            names = model.objects.filter(media=OuterRef('pk')).values(
+                    'media').annotate(names=StringAgg(field, delimiter=' '))
+            return Subquery(names.order_by('names').values('names'),
+                            output_field=models.TextField())
+
+        def foreign_name(model, field, key):
+            '''Name of foreign key metadata.'''
+            name = model.objects.filter(pk=OuterRef(key)).values(field)
+            return Subquery(name, output_field=models.TextField())
+
+        vector = SearchVector('title_pt_br', weight='A', config=config) + \
+                 SearchVector('title_en', weight='A', config=config) + \
+                 SearchVector('caption_pt_br', weight='A', config=config) + \
+                 SearchVector('caption_en', weight='A', config=config) + \
+                 SearchVector(related_names(Person, 'name'), weight='B', config=config) + \
+                 SearchVector(related_names(Tag, 'name_pt_br'), weight='B', config=config) + \
+                 SearchVector(related_names(Tag, 'name_en'), weight='B', config=config) + \
+                 SearchVector(related_names(Taxon, 'name'), weight='B', config=config) + \
+                 SearchVector(foreign_name(Location, 'name', 'location'), weight='C', config=config) + \
+                 SearchVector(foreign_name(City, 'name_pt_br', 'city'), weight='C', config=config) + \
+                 SearchVector(foreign_name(City, 'name_en', 'city'), weight='C', config=config) + \
+                 SearchVector(foreign_name(State, 'name_pt_br', 'state'), weight='C', config=config) + \
+                 SearchVector(foreign_name(State, 'name_en', 'state'), weight='C', config=config) + \
+                 SearchVector(foreign_name(Country, 'name_pt_br', 'country'), weight='C', config=config) + \
+                 SearchVector(foreign_name(Country, 'name_en', 'country'), weight='C', config=config)
+
+        queryset.update(search_vector=vector)
+
     class Meta:
         verbose_name = _('arquivo')
         verbose_name_plural = _('arquivos')
         ordering = ['id']
+        indexes = [GinIndex(fields=['search_vector'], name='meta_media_search_gin')]
 
 
 class Person(models.Model):
@@ -167,6 +244,8 @@ class Taxon(MPTTModel):
             help_text=_('Arquivos associados a este táxon.'))
     timestamp = models.DateTimeField( _('data de modificação'), blank=True,
             null=True, help_text=_('Data da última modificação do arquivo.'))
+    lineage = JSONField(_('linhagem'), default=list, blank=True, editable=False,
+            help_text=_('Ancestrais de ranking principal do táxon (ver refresh_lineage).'))
 
     def __str__(self):
         return self.name
@@ -174,29 +253,159 @@ class Taxon(MPTTModel):
     def get_absolute_url(self):
         return reverse('taxon_url', args=[self.slug])
 
+    @property
+    def main_ancestors(self):
+        '''Main rank ancestors from the materialized lineage, from the root down.'''
+        return [Taxon(**node) for node in self.lineage]
+
+    @staticmethod
+    def refresh_lineage(taxa=None):
+        '''Rebuild the lineage of taxa (list of ids) and their descendants.
+
+        Rebuilds every taxon when no list is given. Lineages are computed by a
+        single query joining each taxon to its MPTT ancestors and only changed
+        rows are written.
+        '''
+        where = ''
+        params = [MAIN_RANKS, MAIN_RANKS]
+        if taxa is not None:
+            taxa = list(taxa)
+            if not taxa:
+                return
+            where = '''WHERE EXISTS (SELECT 1 FROM meta_taxon r WHERE r.id = ANY(%s)
+                AND r.tree_id = t.tree_id AND r.lft <= t.lft AND r.rght >= t.rght)'''
+            params.append(taxa)
+        with connection.cursor() as cursor:
+            cursor.execute(TAXON_LINEAGE_SQL.format(where=where), params)
+
     @staticmethod
     def get_taxon_and_parents(qs):
-        '''Returns all parents and current taxon from a QuerySet of taxons.'''
-        tree_list = {}
-        query = Q()
+        '''Returns all parents and current taxon from a QuerySet of taxons.
+
+        Ancestors are found in a single query, joining the taxa of the QuerySet
+        to the taxa whose MPTT interval contains theirs in the same tree.
+        '''
+        query = qs.values('tree_id', 'lft', 'rght').query
+        query.clear_ordering(force_empty=True)
+        try:
+            sql, params = query.sql_with_params()
+        except EmptyResultSet:
+            return Taxon.objects.none()
+        return Taxon.objects.filter(id__in=RawSQL(TAXON_PARENTS_SQL.format(taxa=sql), params))
 
-        for node in qs.all():
-            if node.tree_id not in tree_list:
-                tree_list[node.tree_id] = []
+    class Meta:
+        verbose_name = _('táxon')
+        verbose_name_plural = _('táxons')
+        ordering = ['name']
 
-            parent = node.parent.pk if node.parent is not None else None,
 
-            if parent not in tree_list[node.tree_id]:
-                tree_list[node.tree_id].append(parent)
+# Ids of taxa (a) containing any of the given taxa (t) in their subtree.
+TAXON_PARENTS_SQL = '''
+    SELECT a.id FROM meta_taxon a JOIN ({taxa}) AS t ON a.tree_id = t.tree_id
+        AND a.lft <= t.lft AND a.rght >= t.rght
+'''
+
+# Ranks shown in taxon lineages (Portuguese and English).
+MAIN_RANKS = ['Reino', 'Filo', 'Classe', 'Ordem', 'Família', 'Gênero', 'Espécie',
+              'Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+# Update lineages of taxa (t) with their main rank ancestors (a).
+TAXON_LINEAGE_SQL = '''
+    UPDATE meta_taxon AS t SET lineage = l.lineage
+    FROM (
+        SELECT t.id, COALESCE(jsonb_agg(jsonb_build_object(
+                'id', a.id, 'name', a.name, 'slug', a.slug,
+                'rank_pt_br', a.rank_pt_br, 'rank_en', a.rank_en)
+                ORDER BY a.lft) FILTER (WHERE a.id IS NOT NULL), '[]') AS lineage
+        FROM meta_taxon t
+        LEFT JOIN meta_taxon a ON a.tree_id = t.tree_id AND a.lft < t.lft
+            AND a.rght > t.rght AND (a.rank_en = ANY(%s) OR a.rank_pt_br = ANY(%s))
+        {where}
+        GROUP BY t.id
+    ) AS l
+    WHERE t.id = l.id AND t.lineage IS DISTINCT FROM l.lineage
+'''
+
+
+class TaxonStats(models.Model):
+    '''Media counters of a taxon, direct and including descendants.
+
+    Counters are refreshed in batch after imports and taxonomic updates (see
+    refresh), so clade counts are read without joining media across subtrees.
+    '''
+    taxon = models.OneToOneField('Taxon', on_delete=models.CASCADE,
+            primary_key=True, related_name='stats', verbose_name=_('táxon'),
+            help_text=_('Táxon destas estatísticas.'))
+    photos = models.PositiveIntegerField(default=0,
+            help_text=_('Número de fotos públicas do táxon.'))
+    videos = models.PositiveIntegerField(default=0,
+            help_text=_('Número de vídeos públicos do táxon.'))
+    private = models.PositiveIntegerField(default=0,
+            help_text=_('Número de arquivos privados do táxon.'))
+    clade_photos = models.PositiveIntegerField(default=0,
+            help_text=_('Número de fotos públicas do táxon e descendentes.'))
+    clade_videos = models.PositiveIntegerField(default=0,
+            help_text=_('Número de vídeos públicos do táxon e descendentes.'))
+    clade_private = models.PositiveIntegerField(default=0,
+            help_text=_('Número de arquivos privados do táxon e descendentes.'))
 
-                query |= Q(lft__lt=node.lft, rght__gt=node.rght, tree_id=node.tree_id)
-            query |= Q(id=node.id)
-        return Taxon.objects.filter(query)
+    def __str__(self):
+        return '{}: {} fotos / {} vídeos ({} fotos / {} vídeos no clado)'.format(
+                self.taxon_id, self.photos, self.videos, self.clade_photos,
+                self.clade_videos)
+
+    @staticmethod
+    def refresh(taxa=None):
+        '''Recount media of taxa (list of ids) and their ancestors.
+
+        Refreshes every taxon when no list is given. Counts are computed by a
+        single grouped query joining each taxon to its MPTT subtree.
+        '''
+        where = ''
+        params = []
+        if taxa is not None:
+            taxa = Taxon.objects.filter(id__in=list(taxa))
+            if not taxa:
+                return
+            ids = list(Taxon.get_taxon_and_parents(taxa).values_list('id', flat=True))
+            where = 'WHERE t.id = ANY(%s)'
+            params = [ids]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(TAXON_STATS_SQL.format(where=where), params)
+        # Counts are shown in the cached taxonomy tree.
+        bump_cache_version('taxonomy')
 
     class Meta:
-        verbose_name = _('táxon')
-        verbose_name_plural = _('táxons')
-        ordering = ['name']
+        verbose_name = _('estatísticas do táxon')
+        verbose_name_plural = _('estatísticas dos táxons')
+
+
+# Upsert media counters for taxa (t) from media of their subtree (d).
+TAXON_STATS_SQL = '''
+    INSERT INTO meta_taxonstats (taxon_id, photos, videos, private,
+                                 clade_photos, clade_videos, clade_private)
+    SELECT t.id,
+        COUNT(DISTINCT m.id) FILTER (WHERE d.id = t.id AND m.is_public AND m.datatype = 'photo'),
+        COUNT(DISTINCT m.id) FILTER (WHERE d.id = t.id AND m.is_public AND m.datatype = 'video'),
+        COUNT(DISTINCT m.id) FILTER (WHERE d.id = t.id AND NOT m.is_public),
+        COUNT(DISTINCT m.id) FILTER (WHERE m.is_public AND m.datatype = 'photo'),
+        COUNT(DISTINCT m.id) FILTER (WHERE m.is_public AND m.datatype = 'video'),
+        COUNT(DISTINCT m.id) FILTER (WHERE NOT m.is_public)
+    FROM meta_taxon t
+    LEFT JOIN meta_taxon d
+        ON d.tree_id = t.tree_id AND d.lft BETWEEN t.lft AND t.rght
+    LEFT JOIN meta_taxon_media tm ON tm.taxon_id = d.id
+    LEFT JOIN meta_media m ON m.id = tm.media_id
+    {where}
+    GROUP BY t.id
+    ON CONFLICT (taxon_id) DO UPDATE SET
+        photos = EXCLUDED.photos,
+        videos = EXCLUDED.videos,
+        private = EXCLUDED.private,
+        clade_photos = EXCLUDED.clade_photos,
+        clade_videos = EXCLUDED.clade_videos,
+        clade_private = EXCLUDED.clade_private
+'''
 
 
 class Location(models.Model):
@@ -338,6 +547,8 @@ class Stats(models.Model):
             help_text=_('Número total de espécies.'))
     locations = models.PositiveIntegerField(default=0,
             help_text=_('Número total de localidades.'))
+    taxa_sync = models.DateTimeField(_('sincronização dos táxons'), null=True,
+            blank=True, help_text=_('Data da última sincronização dos táxons com o WoRMS.'))
 
     def __str__(self):
         return '{}: {} fotos / {} vídeos / {} marcadores / {} espécies / {} locais'.format(
@@ -348,6 +559,62 @@ class Stats(models.Model):
         verbose_name_plural = _('estatísticas')
 
 
+def cache_version(name):
+    '''Current version of a group of cached data.
+
+    Cache keys include the version, so bumping it invalidates the group.
+    Versions are kept in their own cache ('versions'), which is not culled
+    with the cached data.
+    '''
+    return caches['versions'].get_or_set('version:{}'.format(name), time.time_ns(), None)
+
+
+def bump_cache_version(name):
+    '''Invalidates a group of cached data.
+
+    The new version is the current time in nanoseconds, or the next one if
+    the clock is behind, so an unknown or evicted version never restarts from
+    a version used before. Concurrent bumps both move past the old version.
+    '''
+    versions = caches['versions']
+    key = 'version:{}'.format(name)
+    versions.set(key, max(versions.get(key, 0) + 1, time.time_ns()), None)
+
+
+# Number of media kept per metadata item to pick thumbnails from.
+THUMB_POOL_SIZE = 5
+
+# Media fields shown in thumbnails (thumb.html).
+THUMB_FIELDS = ('coverpath', 'datatype', 'duration', 'size', 'title', 'caption')
+
+
+def thumbnail_pool(field):
+    '''Return {id: [media]} with a few random public media per metadata item.
+
+    The pool of a field (e.g., 'tag') is built with a ranking query and cached
+    until the media or the field's model change, so that listing pages pick
+    thumbnails in memory. Only the fields shown in thumbnails are loaded.
+    '''
+    version = cache_version('taxonomy' if field == 'taxon' else field)
+    key = 'thumbs:{}:{}:{}'.format(field, cache_version('media'), version)
+    pool = cache.get(key)
+    if pool is None:
+        ranked = Media.objects.filter(is_public=True).exclude(**{field: None}).annotate(
+                item=F(field), position=Window(RowNumber(), partition_by=F(field),
+                    order_by=RawSQL('random()', []))).values('id', 'item', 'position')
+        sql, params = ranked.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, item FROM ({}) AS ranked WHERE position <= %s'.format(sql),
+                           params + (THUMB_POOL_SIZE,))
+            rows = cursor.fetchall()
+        media = Media.objects.only(*THUMB_FIELDS).in_bulk([id for id, item in rows])
+        pool = {}
+        for id, item in rows:
+            pool.setdefault(item, []).append(media[id])
+        cache.set(key, pool, None)
+    return pool
+
+
 # Slugify before saving.
 models.signals.pre_save.connect(slug_pre_save, sender=Person)
 models.signals.pre_save.connect(slug_pre_save, sender=Tag)
@@ -362,3 +629,42 @@ models.signals.pre_save.connect(slug_pre_save, sender=Tour)
 
 # Create citation with bibkey.
 models.signals.pre_save.connect(citation_pre_save, sender=Reference)
+
+# Keep media search vectors up to date.
+models.signals.post_save.connect(search_vector_post_save, sender=Media)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=Person)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=Tag)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=Taxon)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=Location)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=City)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=State)
+models.signals.pre_save.connect(search_vector_meta_pre_save, sender=Country)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=Person)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=Tag)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=Taxon)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=Location)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=City)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=State)
+models.signals.post_save.connect(search_vector_meta_post_save, sender=Country)
+models.signals.m2m_changed.connect(search_vector_m2m_changed, sender=Person.media.through)
+models.signals.m2m_changed.connect(search_vector_m2m_changed, sender=Tag.media.through)
+models.signals.m2m_changed.connect(search_vector_m2m_changed, sender=Taxon.media.through)
+
+# Invalidate cached taxonomy tree.
+models.signals.post_save.connect(taxonomy_changed, sender=Taxon)
+models.signals.post_delete.connect(taxonomy_changed, sender=Taxon)
+
+# Invalidate cached site stats.
+models.signals.post_save.connect(stats_changed, sender=Stats)
+
+# Invalidate cached searches and the media index (see meta/bitmaps.py) when
+# media links change.
+for model in (Person, Tag, Taxon, Reference):
+    models.signals.m2m_changed.connect(media_links_changed, sender=model.media.through)
+for model in (Media, Person, Tag, Taxon, Reference, Location, City, State, Country):
+    models.signals.post_delete.connect(media_links_changed, sender=model)
+
+# Invalidate cached pages listing metadata (see cache_versions in views).
+for model in (Person, Tag, Category, Location, City, State, Country, Reference, Tour):
+    models.signals.post_save.connect(metadata_changed, sender=model)
+    models.signals.post_delete.connect(metadata_changed, sender=model)
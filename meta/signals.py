@@ -195,3 +195,78 @@ def set_position(signal, instance, sender, **kwargs):
         except:
             tp = TourPosition(media=item, tour=instance)
             tp.save()
+
+
+def search_vector_post_save(signal, instance, sender, **kwargs):
+    '''Update search vector of saved media.'''
+    sender.update_search_vector(sender.objects.filter(id=instance.id))
+
+
+def search_vector_meta_pre_save(signal, instance, sender, **kwargs):
+    '''Check if the names of metadata used in search vectors changed.'''
+    fields = [f for f in ('name', 'name_pt_br', 'name_en') if hasattr(instance, f)]
+    if instance.pk:
+        stored = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+        current = tuple(getattr(instance, f) for f in fields)
+        instance._renamed = stored is not None and stored != current
+    else:
+        instance._renamed = False
+
+
+def search_vector_meta_post_save(signal, instance, sender, **kwargs):
+    '''Update search vectors of media associated with renamed metadata.'''
+    if not getattr(instance, '_renamed', False):
+        return
+    from meta.models import Media
+    if hasattr(instance, 'media'):
+        media = instance.media.all()
+    else:
+        media = instance.media_set.all()
+    Media.update_search_vector(Media.objects.filter(id__in=media.values('id')))
+
+
+def search_vector_m2m_changed(signal, instance, sender, action, reverse, pk_set, **kwargs):
+    '''Update search vectors of media when their metadata sets change.'''
+    from meta.models import Media
+    # Media of the metadata object are gone after clearing it.
+    if action == 'pre_clear' and not reverse:
+        instance._cleared_media = list(instance.media.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        media_ids = [instance.pk]
+    elif action == 'post_clear':
+        media_ids = getattr(instance, '_cleared_media', [])
+    else:
+        media_ids = pk_set
+    if media_ids:
+        Media.update_search_vector(Media.objects.filter(id__in=media_ids))
+
+
+def taxonomy_changed(signal, instance, sender, **kwargs):
+    '''Invalida dados em cache que dependem da árvore de táxons.'''
+    from meta.models import bump_cache_version
+    bump_cache_version('taxonomy')
+
+
+def stats_changed(signal, instance, sender, **kwargs):
+    '''Invalida estatísticas do site em cache.'''
+    from meta.models import bump_cache_version
+    bump_cache_version('stats')
+
+
+def metadata_changed(signal, instance, sender, **kwargs):
+    '''Invalida páginas em cache que listam o modelo alterado.'''
+    from meta.models import bump_cache_version
+    bump_cache_version(sender._meta.model_name)
+
+
+def media_links_changed(signal, sender, action=None, **kwargs):
+    '''Invalida buscas em cache e o índice de mídia quando mudam os vínculos.
+
+    Chamada quando conjuntos de mídia de metadados mudam (inclusive pelo
+    admin) e quando metadados indexados são apagados.
+    '''
+    if action in (None, 'post_add', 'post_remove', 'post_clear'):
+        from meta.models import bump_cache_version
+        bump_cache_version('media')
@@ -1,23 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import operator
+import random
 
 from django import template
 from django.apps import apps
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.db.models import Q
+from django.db.models import Count, Q
+from django.core.cache import cache
 from django.template.defaultfilters import slugify
+from django.template.loader import render_to_string
 from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, get_language
 from meta.forms import *
+from meta.models import cache_version
 
 register = template.Library()
 
 # TODO: Cleanup this file...
 
-main_ranks = [u'Reino', u'Filo', u'Classe', u'Ordem', u'Família', u'Gênero', u'Espécie', u'Kingdom', u'Phylum', u'Class', u'Order', u'Family', u'Genus', u'Species']
-
 @register.inclusion_tag('metalist.html')
 def print_metalist(metalist, field):
     '''Mostra lista de metadados com contador de imagens.'''
@@ -27,22 +29,21 @@ def print_metalist(metalist, field):
 def taxon_paths(taxon):
     '''Mostra classificação de um táxon de forma linear.
 
-    Exclui subrankings da lista.
+    Exclui subrankings da lista. Usa a linhagem materializada do táxon (ver
+    Taxon.refresh_lineage), sem consultas ao banco.
     '''
-    ancestors = [t for t in taxon.get_ancestors() if t.rank in main_ranks]
-    return {'taxon': taxon, 'ancestors': ancestors}
+    return {'taxon': taxon, 'ancestors': taxon.main_ancestors}
 
 @register.inclusion_tag('thumb_org.html', takes_context=True)
-def print_thumb(context, field, obj):
-    '''Generates random thumbnail for supplied metadata.'''
-    # Load model and parameters
-    Media = apps.get_model('meta', 'Media')
+def print_thumb(context, pool, obj):
+    '''Generates random thumbnail for supplied metadata.
+
+    Picks from the precomputed pool of media of the field (thumbnail_pool),
+    given by the view and loaded once per page.
+    '''
     media_url = context['MEDIA_URL']
-    params = {field: obj, 'is_public': True}
-    try:
-        media = Media.objects.filter(**params).order_by('?')[0]
-    except:
-        media = ''
+    media = pool.get(obj.id)
+    media = random.choice(media) if media else ''
     return {'media': media, 'MEDIA_URL': media_url}
 
 
@@ -53,19 +54,17 @@ def slicer(query, media_id):
     next/previous related images, and chop queryset to fit the 5 thumbnails of the
     linear browser.
 
+    Only the images shown are loaded: the index comes from a count of the
+    images before and after, and the images from a single union of keyset
+    queries (first and last 2, up to 5 before and after the image).
     '''
 
     # Get image index within queryset.
-    for index, item in enumerate(query):
-        if item.id == media_id:
-            media_index = index
-            break
-        else:
-            continue
-
-    # Calculate how many ahead and behind.
-    ahead = len(query[media_index:]) - 1
-    behind = len(query[:media_index])
+    counts = query.aggregate(
+            behind=Count('id', filter=Q(id__lt=media_id)),
+            ahead=Count('id', filter=Q(id__gt=media_id)))
+    behind, ahead = counts['behind'], counts['ahead']
+    media_index = behind
 
     # Main object with relative positions.
     relative = {
@@ -75,7 +74,33 @@ def slicer(query, media_id):
         }
 
     # Total length of the queryset.
-    size = len(query)
+    size = behind + ahead + 1
+
+    # Fetch images around the current one and at both ends.
+    before = query.filter(id__lt=media_id)
+    after = query.filter(id__gt=media_id)
+    rows = query.filter(id=media_id).union(
+            before.order_by('id')[:2], before.order_by('-id')[:5],
+            after.order_by('id')[:5], after.order_by('-id')[:2]).order_by('id')
+
+    # Map images to their index. Rows before the image are the first ones,
+    # then the 5 previous; rows after are the 5 next, then the last ones.
+    items = {}
+    rows_before = [row for row in rows if row.id < media_id]
+    rows_after = [row for row in rows if row.id > media_id]
+    current = [row for row in rows if row.id == media_id]
+    for i, row in enumerate(rows_before):
+        if i < len(rows_before) - min(5, behind):
+            items[i] = row
+        else:
+            items[media_index - len(rows_before) + i] = row
+    for i, row in enumerate(rows_after):
+        if i < min(5, ahead):
+            items[media_index + 1 + i] = row
+        else:
+            items[size - len(rows_after) + i] = row
+    if current:
+        items[media_index] = current[0]
 
     # Matrix with conditionals for getting relative objects. First and last 2
     # are covered, others should not overlap, that is why media_index - value
@@ -97,7 +122,7 @@ def slicer(query, media_id):
     # Populate relative object only with available relative images.
     for cond, field, index in conditionals:
         if cond:
-            relative[field] = {'index': index + 1, 'obj': query[index]}
+            relative[field] = {'index': index + 1, 'obj': items[index]}
         else:
             relative[field] = None
 
@@ -106,10 +131,11 @@ def slicer(query, media_id):
         media_index = 2
 
     # Slice full query to 5 images when necessary.
-    if len(query) <= 5:
-        rel_query = query
+    if size <= 5:
+        indexes = range(size)
     else:
-        rel_query = query[media_index - 2:media_index + 3]
+        indexes = range(media_index - 2, min(media_index + 3, size))
+    rel_query = [items[index] for index in indexes if index in items]
 
     return rel_query, relative
 
@@ -117,7 +143,8 @@ def slicer(query, media_id):
 def mediaque(media, qobj):
     '''Returns queryset used in the linear browser.'''
     Media = apps.get_model('meta', 'Media')
-    query = Media.objects.filter(qobj, is_public=True).order_by('id')
+    query = Media.objects.filter(is_public=True, id__in=Media.objects.filter(
+            qobj).values('id')).order_by('id')
     return query
 
 @register.inclusion_tag('related.html', takes_context=True)
@@ -225,25 +252,44 @@ def show_related(context, media, form, related):
 
 @register.inclusion_tag('stats.html')
 def show_stats():
-    '''Generates the stats line in the header.'''
-    # Load model.
-    Stats = apps.get_model('meta', 'Stats')
-    cifo = Stats.objects.get(site='cifonauta')
+    '''Generates the stats line in the header.
 
-    return {'photos': cifo.photos, 'videos': cifo.videos, 'species':
-            cifo.species, 'locations': cifo.locations, 'tags': cifo.tags}
+    Stats are cached until the next change of the stats object.
+    '''
+    key = 'stats:{}'.format(cache_version('stats'))
+    stats = cache.get(key)
+    if stats is None:
+        # Load model.
+        Stats = apps.get_model('meta', 'Stats')
+        cifo = Stats.objects.get(site='cifonauta')
+        stats = {'photos': cifo.photos, 'videos': cifo.videos, 'species':
+                cifo.species, 'locations': cifo.locations, 'tags': cifo.tags}
+        cache.set(key, stats, None)
+    return stats
 
-@register.inclusion_tag('tree.html')
+@register.simple_tag
 def show_tree(current=None):
     '''Passa objeto para gerar árvore.
 
     Usa o recursetree do MPTT no template para gerar a árvore. Aceita argumento opcional para pré-expandir os nós mostrando os táxons da imagem aberta.
 
     Usar o selected_related para pegar o 'parent' diminuiu 100 queries!
+
+    A árvore renderizada fica no cache, por língua, até a próxima mudança na
+    taxonomia (versão 'taxonomy'). Os nós abertos são marcados depois, no
+    html do cache.
     '''
     Taxon = apps.get_model('meta', 'Taxon')
-    taxa = Taxon.objects.select_related('parent')
-    return {'taxa': taxa, 'current': current}
+    key = 'tree:{}:{}'.format(cache_version('taxonomy'), get_language())
+    tree = cache.get(key)
+    if tree is None:
+        taxa = Taxon.objects.select_related('parent', 'stats')
+        tree = render_to_string('tree.html', {'taxa': taxa})
+        cache.set(key, tree, None)
+    for taxon in current or []:
+        node = '" id="taxa{}">'.format(taxon.pk)
+        tree = tree.replace(node, ' open' + node, 1)
+    return mark_safe(tree)
 
 @register.inclusion_tag('search_box.html')
 def search_box(query=None):
@@ -329,13 +375,19 @@ def truncate(value, arg):
         return value
 
 @register.simple_tag
-def paged_url(query_string, page_number):
-    '''Constrói o url para lidar navegação paginada.'''
+def paged_url(query_string, page_number, seed='', cursor=''):
+    '''Constrói o url para lidar navegação paginada.
+
+    A semente da ordem aleatória e o cursor da página (after=... ou
+    before=...), quando houver, são mantidos no url.
+    '''
     url = '?'
-    queries = query_string.split('&')
-    for query in queries:
-        if query.startswith('page'):
-            queries.remove(query)
+    queries = [query for query in query_string.split('&') if query and not
+               query.startswith(('page', 'seed=', 'after=', 'before='))]
+    if seed != '':
+        queries.append('seed=%s' % seed)
+    if cursor:
+        queries.append(cursor)
     if queries:
         url = url + '&'.join(queries) + '&page=%d' % page_number
     else:
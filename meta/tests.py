@@ -5,7 +5,10 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from meta.models import Media, Person, Stats, Tag, Taxon, Tour
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +24,91 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+@override_settings(THUMBNAIL_DUMMY=True, CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+    'versions': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class MediaPageQueriesTest(TestCase):
+    '''The media page runs a fixed number of queries.
+
+    Metadata is prefetched and taxon ancestors read from their lineage, so the
+    number of queries does not depend on how many tags, authors and taxa a
+    media has.
+    '''
+
+    # Queries of a media page, with any amount of metadata.
+    QUERIES = 11
+
+    @classmethod
+    def setUpTestData(cls):
+        Stats.objects.get_or_create(site='cifonauta')
+        cls.simple = cls.create_media('cover.jpg', 1)
+        cls.full = cls.create_media('other.jpg', 5)
+
+    @classmethod
+    def create_media(cls, path, n):
+        media = Media.objects.create(filepath='source/' + path,
+                sitepath=path, coverpath=path, datatype='photo',
+                timestamp=timezone.now(), is_public=True, title=path)
+        parent = None
+        for i in range(n):
+            media.tag_set.add(Tag.objects.create(name='{} tag {}'.format(path, i)))
+            media.person_set.add(Person.objects.create(
+                name='{} person {}'.format(path, i), is_author=bool(i % 2)))
+            parent = Taxon.objects.create(name='{} taxon {}'.format(path, i),
+                    rank='Filo', parent=parent)
+            media.taxon_set.add(parent)
+            Tour.objects.create(name='{} tour {}'.format(path, i)).media.add(media)
+        return media
+
+    def test_media_page_queries(self):
+        for media in (self.simple, self.full):
+            with self.assertNumQueries(self.QUERIES):
+                response = self.client.get(media.get_absolute_url())
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, media.title)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+    'versions': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class TaxonParentsTest(TestCase):
+    '''Ancestors of any set of taxa are fetched in a single query.
+
+    Sets of increasing size are taken from two trees with the main ranks and
+    compared with the ancestors found by MPTT node by node.
+    '''
+
+    # Rank and number of children of each node of that rank.
+    RANKS = (('Kingdom', 4), ('Phylum', 2), ('Class', 2), ('Order', 2),
+             ('Family', 2), ('Genus', 3), ('Species', 0))
+
+    # Sizes of the sets of species.
+    SIZES = (1, 10, 100, 384)
+
+    @classmethod
+    def setUpTestData(cls):
+        with Taxon.objects.disable_mptt_updates():
+            for kingdom in ('Animalia', 'Plantae'):
+                cls.create_taxa(kingdom, None, 0)
+        Taxon.objects.rebuild()
+
+    @classmethod
+    def create_taxa(cls, name, parent, level):
+        rank, children = cls.RANKS[level]
+        taxon = Taxon.objects.create(name=name, rank_en=rank, parent=parent)
+        for i in range(children):
+            cls.create_taxa('{} {}'.format(name, i), taxon, level + 1)
+
+    def test_get_taxon_and_parents(self):
+        species = list(Taxon.objects.filter(rank_en='Species').order_by('?').values_list(
+                'id', flat=True))
+        self.assertEqual(len(species), self.SIZES[-1])
+        for size in self.SIZES:
+            with self.subTest(size=size):
+                taxa = Taxon.objects.filter(id__in=species[:size])
+                expected = {ancestor.id for taxon in taxa
+                            for ancestor in taxon.get_ancestors(include_self=True)}
+                with self.assertNumQueries(1):
+                    ids = set(Taxon.get_taxon_and_parents(taxa).values_list('id', flat=True))
+                self.assertEqual(ids, expected)
@@ -1,22 +1,80 @@
 # -*- coding: utf-8 -*-
 
+import binascii
 import json
 import logging
 import os
+import random
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import md5
+from math import ceil
 
 from django.http import HttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
-from django.db.models import Q
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connection, transaction
+from django.db.models import Count, F, Prefetch, Q, Subquery
+from django.db.models.expressions import RawSQL
+from django.utils.functional import SimpleLazyObject, cached_property
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.urls import reverse
+from django.views.decorators.cache import cache_control
+from django.utils import timezone
 from django.contrib.auth.decorators import login_required
-from django.contrib.postgres.search import SearchVector, SearchQuery
-from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from functools import reduce
 from operator import or_, and_
 
 from .models import *
 from .forms import *
+from .bitmaps import MediaIndex
+
+
+# Maximum number of media ranked by relevance in a text search.
+RANK_LIMIT = 1000
+
+# Seeds for the random ordering are drawn from this range.
+SEED_RANGE = 1000000
+
+# Result sets estimated above this size are not counted exactly.
+COUNT_ESTIMATE_THRESHOLD = 10000
+
+# Query parameters of metadata filters and the respective media fields.
+FILTER_FIELDS = (
+        ('author', 'person'),
+        ('tag', 'tag'),
+        ('taxon', 'taxon'),
+        ('location', 'location'),
+        ('city', 'city'),
+        ('state', 'state'),
+        ('country', 'country'),
+        ('reference', 'reference'),
+        )
+
+# Form fields of the sidebar facets and the respective media fields.
+FACET_FIELDS = (
+        ('author', 'person'),
+        ('tag', 'tag'),
+        ('location', 'location'),
+        ('city', 'city'),
+        ('state', 'state'),
+        ('country', 'country'),
+        )
+
+# Parameters that do not change the number of results.
+COUNT_IGNORED = ('page', 'n', 'orderby', 'order', 'seed', 'after', 'before')
+
+
+def cache_versions(*names):
+    '''Return the vary_on key of cached page fragments.
+
+    Listing pages cache their content with the cache template tag, keyed by
+    this string and the language, until one of the named versions changes.
+    Fragments depend on the media version as well (thumbnails and counts).
+    '''
+    return ':'.join(str(cache_version(name)) for name in ('media',) + names)
 
 
 # Home
@@ -25,18 +83,18 @@ def home_page(request):
 
     # Photos
     try:
-        highlights = Media.objects.filter(highlight=True, is_public=True).order_by('?')
-        main_image = highlights.filter(datatype='photo')[0]
-        photo = highlights.filter(datatype='photo')[1]
-        video = highlights.filter(datatype='video')[0]
+        highlights = Media.objects.filter(highlight=True, is_public=True)
+        main_image, photo = highlights.filter(datatype='photo').random(2)
+        video = highlights.filter(datatype='video').random()[0]
     except:
         main_image, photo, video = '', '', ''
 
     # Tours
     try:
-        tour = Tour.objects.order_by('?')[0]
+        tours = Tour.objects.all()
+        tour = tours[random.randrange(tours.count())]
         tour_image = tour.media.exclude(id=main_image.id).exclude(
-                id=photo.id).order_by('?')[0]
+                id=photo.id).random()[0]
     except:
         tour, tour_image = '', ''
 
@@ -84,127 +142,97 @@ def search_page(request, model_name='', field='', slug=''):
             # TODO: if search_type='raw' create conditional
             search_query = SearchQuery(query, config='portuguese_unaccent')
 
-            # Create search vectors
+            # Filter media_list by search_query using the stored search vector
             # TODO: create and search location translations
-            vector = SearchVector('title_pt_br', weight='A', config='portuguese_unaccent') + \
-                     SearchVector('title_en', weight='A', config='portuguese_unaccent') + \
-                     SearchVector('caption_pt_br', weight='A', config='portuguese_unaccent') + \
-                     SearchVector('caption_en', weight='A', config='portuguese_unaccent') + \
-                     SearchVector(StringAgg('person__name', delimiter=' '), weight='B', config='portuguese_unaccent') + \
-                     SearchVector(StringAgg('tag__name_pt_br', delimiter=' '), weight='B', config='portuguese_unaccent') + \
-                     SearchVector(StringAgg('tag__name_en', delimiter=' '), weight='B', config='portuguese_unaccent') + \
-                     SearchVector(StringAgg('taxon__name', delimiter=' '), weight='B', config='portuguese_unaccent') + \
-                     SearchVector('location__name', weight='C', config='portuguese_unaccent') + \
-                     SearchVector('city__name_pt_br', weight='C', config='portuguese_unaccent') + \
-                     SearchVector('city__name_en', weight='C', config='portuguese_unaccent') + \
-                     SearchVector('state__name_pt_br', weight='C', config='portuguese_unaccent') + \
-                     SearchVector('state__name_en', weight='C', config='portuguese_unaccent') + \
-                     SearchVector('country__name_pt_br', weight='C', config='portuguese_unaccent') + \
-                     SearchVector('country__name_en', weight='C', config='portuguese_unaccent')
-
-            # Filter media_list by search_query
-            media_list = media_list.annotate(search=vector).filter(search=search_query)
+            media_list = media_list.filter(search_vector=search_query)
 
-        # Operator
-        operator = query_dict.get('operator', 'or')
+        # Get highlights only.
+        highlight = query_dict.get('highlight', False)
+        if highlight:
+            media_list = media_list.filter(highlight=1)
 
-        # Author
-        if 'author' in query_dict:
-            # Extract objects from query_dict.
-            get_authors = query_dict.getlist('author')
-            authors = Person.objects.filter(id__in=get_authors)
+        # Media before the metadata filters, for the sidebar facets.
+        unfiltered_list = media_list
 
-            # Filter media by field and operator.
-            media_list = filter_request(media_list, authors, 'person', operator)
+        # Operator
+        operator = query_dict.get('operator', 'or')
 
-            # Fill form with values.
-            form_authors = list(get_authors)
-        else:
-            form_authors = []
-
-        # Tag
-        if 'tag' in query_dict:
-            get_tags = query_dict.getlist('tag')
-            tags = Tag.objects.filter(id__in=get_tags)
-            media_list = filter_request(media_list, tags, 'tag', operator)
-            form_tags = list(get_tags)
+        # Filter media by metadata fields and operator in the same query, or
+        # resolve the ids in the in-memory index when enabled.
+        index = MediaIndex.get()
+        if index:
+            ids = index.filter(query_dict, operator)
         else:
-            form_tags = []
-
-        # Taxon
-        if 'taxon' in query_dict:
-            get_taxa = query_dict.getlist('taxon')
-            taxa = Taxon.objects.filter(id__in=get_taxa)
-            media_list = filter_request(media_list, taxa, 'taxon', operator)
-            form_taxa = list(get_taxa)
-        else:
-            form_taxa = []
-
-        # Location
-        if 'location' in query_dict:
-            get_locations = query_dict.getlist('location')
-            locations = Location.objects.filter(id__in=get_locations)
-            media_list = filter_request(media_list, locations, 'location', operator)
-            form_locations = list(get_locations)
-        else:
-            form_locations = []
-
-        # City
-        if 'city' in query_dict:
-            get_cities = query_dict.getlist('city')
-            cities = City.objects.filter(id__in=get_cities)
-            media_list = filter_request(media_list, cities, 'city', operator)
-            form_cities = list(get_cities)
-        else:
-            form_cities = []
-
-        # State
-        if 'state' in query_dict:
-            get_states = query_dict.getlist('state')
-            states = State.objects.filter(id__in=get_states)
-            media_list = filter_request(media_list, states, 'state', operator)
-            form_states = list(get_states)
-        else:
-            form_states = []
-
-        # Country
-        if 'country' in query_dict:
-            get_countries = query_dict.getlist('country')
-            countries = Country.objects.filter(id__in=get_countries)
-            media_list = filter_request(media_list, countries, 'country', operator)
-            form_countries = list(get_countries)
-        else:
-            form_countries = []
-
-        # Reference
-        if 'reference' in query_dict:
-            get_references = query_dict.getlist('reference')
-            references = Reference.objects.filter(id__in=get_references)
-            media_list = filter_request(media_list, references, 'reference', operator)
-            form_references = list(get_references)
-        else:
-            form_references = []
+            media_list = media_list.filter(compile_filters(query_dict, operator))
 
-        # Sort and display options.
+        # Fill form with values.
+        form_authors = query_dict.getlist('author')
+        form_tags = query_dict.getlist('tag')
+        form_taxa = query_dict.getlist('taxon')
+        form_locations = query_dict.getlist('location')
+        form_cities = query_dict.getlist('city')
+        form_states = query_dict.getlist('state')
+        form_countries = query_dict.getlist('country')
 
-        # Get highlights only.
-        highlight = query_dict.get('highlight', False)
-        if highlight:
-            media_list = media_list.filter(highlight=1)
+        # Sort and display options.
 
-        # Orderby: replace 'random' by '?'
-        orderby = query_dict.get('orderby', 'random')
+        # Orderby: 'random' walks the random key index from a random point.
+        # Text searches are sorted by relevance unless told otherwise.
+        orderby = query_dict.get('orderby', 'rank' if query else 'random')
         order = query_dict.get('order', 'desc')
-        if orderby == 'random':
-            sorting = '?'
+        if orderby == 'rank' and not query:
+            orderby = 'random'
+        if orderby == 'rank':
+            sorting = None
+        elif orderby == 'random':
+            sorting = 'random_key'
         else:
             if order == 'desc':
                 sorting = '-{}'.format(orderby)
             else:
                 sorting = orderby
 
-        # Sort media.
-        media_list = media_list.order_by(sorting)
+        # Random order is seeded and the seed is carried in the page links, so
+        # every page of the results follows the same order.
+        seed = ''
+        if sorting == 'random_key':
+            try:
+                seed = int(query_dict.get('seed', ''))
+            except ValueError:
+                seed = random.randrange(SEED_RANGE)
+
+        # Pages in random order without a text search are picked from the
+        # index. Otherwise ids resolved in the index are sent to the database,
+        # only if a metadata filter is set.
+        in_memory = index and not query and sorting == 'random_key'
+        if index and not in_memory and index.parse(query_dict):
+            media_list = media_list.filter(id__in=RawSQL(
+                'SELECT unnest(%s::integer[])', (list(ids),)))
+
+        # Filtered media, before sorting. Ranked results are cut at RANK_LIMIT
+        # but share the cached count of the filters, capped when used.
+        counted_list = media_list
+        ranked = sorting is None
+
+        # Sort media. Keys are the sort columns used for keyset pagination,
+        # ties are broken by id. Image dates may be empty and the rank is
+        # computed, so these are paginated by offset.
+        keys = None
+        pivot = None
+        if sorting == 'random_key':
+            pivot = random.Random(seed).random()
+        elif sorting:
+            ordering = [sorting]
+            if orderby != 'id':
+                ordering.append('-id' if order == 'desc' else 'id')
+            media_list = media_list.order_by(*ordering)
+            if orderby != 'date':
+                keys = ordering
+        else:
+            # Rank only the media matched by the index and keep the best ones.
+            media_list = media_list.annotate(
+                rank=SearchRank(F('search_vector'), search_query)
+                ).order_by('-rank', 'id')[:RANK_LIMIT]
 
         # Forçar int para paginator.
         n_page = int(query_dict.get('n', '40'))
@@ -226,43 +254,72 @@ def search_page(request, model_name='', field='', slug=''):
             'country': form_countries,
             'taxon': form_taxa,
             })
+        if index and not query:
+            params = [param for param, field in FACET_FIELDS]
+            facets = cache.get_or_set('facets:' + filter_key(query_dict),
+                                      lambda: index.facets(query_dict, operator, params))
+        else:
+            facets = facet_counts(query_dict, unfiltered_list, operator)
+        display_form.set_facets(facets)
 
     else:
         # Define initial display form.
         display_form = DisplayForm()
+        seed = ''
+        keys = None
+        pivot = None
+        index = None
+        in_memory = False
+        ranked = False
+        counted_list = media_list
 
     # Return paginated list.
-    entries = get_paginated(query_dict, media_list, n_page)
+    if index and not query:
+        count = index.count(ids)
+    else:
+        count = count_media(query_dict, counted_list)
+        if ranked:
+            count = min(count, RANK_LIMIT)
+    paginator = None
+    if in_memory:
+        paginator = IndexShuffledPaginator(media_list, n_page, pivot, index, ids)
+    entries = get_paginated(query_dict, media_list, n_page, keys, count, pivot,
+                            paginator)
 
     context = {
         'entries': entries,
         'display_form': display_form,
         'meta': instance,
         'field': field,
+        'seed': seed,
         }
     return render(request, 'search.html', context)
 
 
+@cache_control(max_age=0)
 def org_page(request):
     '''Página mostrando a organização dos metadados.
 
     Além de buscar as descrições de cada categoria, mostra exemplos aleatórios de imagens.
+    As categorias só são buscadas se o conteúdo não estiver em cache.
     '''
     # Tamanhos
-    sizes = Category.objects.get(name_en='Size')
+    sizes = SimpleLazyObject(lambda: Category.objects.get(name_en='Size'))
     # Técnicas
-    technique = Category.objects.get(name_en='Imaging technique')
-    microscopy = Category.objects.get(name_en='Microscopy')
+    technique = SimpleLazyObject(lambda: Category.objects.get(name_en='Imaging technique'))
+    microscopy = SimpleLazyObject(lambda: Category.objects.get(name_en='Microscopy'))
     # Estágios
-    stage = Category.objects.get(name_en='Life stage')
-    stages = stage.tags.all()
+    stage = SimpleLazyObject(lambda: Category.objects.get(name_en='Life stage'))
+    stages = SimpleLazyObject(lambda: stage.tags.all())
     # Modos
-    mode = Category.objects.get(name_en='Life mode')
+    mode = SimpleLazyObject(lambda: Category.objects.get(name_en='Life mode'))
     # Habitat
-    habitat = Category.objects.get(name_en='Habitat')
+    habitat = SimpleLazyObject(lambda: Category.objects.get(name_en='Habitat'))
     # Diversos
-    assorted = Category.objects.get(name_en='Miscellaneous')
+    assorted = SimpleLazyObject(lambda: Category.objects.get(name_en='Miscellaneous'))
     context = {
+        'versions': cache_versions('tag', 'category'),
+        'thumbs': SimpleLazyObject(lambda: thumbnail_pool('tag')),
         'sizes': sizes,
         'microscopy': microscopy,
         'technique': technique,
@@ -290,8 +347,11 @@ def old_media(request, datatype, old_id):
 def media_page(request, media_id):
     '''Invididual page for media file with all the information.'''
 
-    # Get object.
-    media = get_object_or_404(Media.objects.select_related('location', 'city', 'state', 'country'), id=media_id)
+    # Get object with all its metadata.
+    media = get_object_or_404(Media.objects.select_related(
+        'location', 'city', 'state', 'country').prefetch_related(
+        'tag_set', 'person_set', 'taxon_set', 'reference_set', 'tour_set'),
+        id=media_id)
 
     # Nullify forms.
     form, admin_form = None, None
@@ -307,43 +367,23 @@ def media_page(request, media_id):
     elif request.method == 'POST' and 'admin' in request.POST:
         admin_form = AdminForm(request.POST)
         if admin_form.is_valid():
-            # Se algum tour tiver sido submetido no formulário.
-            if 'tours' in request.POST:
-                # Pega a lista de tours ligadas à imagem.
-                media_tours = media.tour_set.values_list('id', flat=True)
-                # Define lista de tours submetidos no formulário.
-                form_tours = [int(id) for id in admin_form.cleaned_data['tours']]
-                # Usa sets para descobrir imagens que foram removidas,
-                remove_media = set(media_tours) - set(form_tours)
-                # e imagens que devem ser adicionadas.
-                add_media = set(form_tours) - set(media_tours)
-                # Remove imagem de cada tour.
-                for tour_id in remove_media:
-                    tour = Tour.objects.get(id=tour_id)
-                    tour.media.remove(media)
-                    tour.save()
-                # Adiciona imagem em cada tour.
-                for tour_id in add_media:
-                    tour = Tour.objects.get(id=tour_id)
-                    tour.media.add(media)
-                    tour.save()
-
-            # Caso nenhum tour tenha sido selecionado.
-            else:
-                # Se tours estiverem desmarcados, retirar imagem de todos.
-                media_tours = media.tour_set.all()
-                # Mas, somente se ela está em algum.
-                if media_tours:
-                    for tour in media_tours:
-                        tour.media.remove(media)
-                        tour.save()
-            # Atualiza campo do destaque.
-            if 'highlight' in request.POST:
-                media.highlight = True
-            else:
-                media.highlight = False
-            # Salva imagem.
-            media.save()
+            with transaction.atomic():
+                # Tours submetidos no formulário (nenhum se desmarcados).
+                form_tours = {tour.id for tour in admin_form.cleaned_data['tours']}
+                # Tours que ganharam ou perderam a imagem.
+                media_tours = {tour.id for tour in media.tour_set.all()}
+                changed = media_tours ^ form_tours
+                if changed:
+                    # Aplica a diferença na tabela intermediária de uma vez.
+                    media.tour_set.set(form_tours)
+                    Tour.objects.filter(id__in=changed).update(timestamp=timezone.now())
+                # Atualiza campo do destaque.
+                media.highlight = 'highlight' in request.POST
+                # Salva imagem.
+                media.save()
+            if changed:
+                bump_cache_version('tour')
+            bump_cache_version('media')
     if not form:
         try:
             form = RelatedForm(initial={'type': request.session['rel_type']})
@@ -353,7 +393,7 @@ def media_page(request, media_id):
             related = 'taxon'
     if not admin_form:
         try:
-            tour_list = media.tour_set.values_list('id', flat=True)
+            tour_list = [tour.id for tour in media.tour_set.all()]
             admin_form = AdminForm(initial={
                 'highlight': media.highlight,
                 'tours': tour_list
@@ -365,8 +405,9 @@ def media_page(request, media_id):
                 'tours': tour_list
                 })
 
+    # Related objects come from the prefetched lists.
     tags = media.tag_set.all()
-    authors = media.person_set.filter(is_author=True)
+    authors = [person for person in media.person_set.all() if person.is_author]
     taxa = media.taxon_set.all()
     sources = media.person_set.all()
     references = media.reference_set.all()
@@ -394,7 +435,8 @@ def tour_page(request, slug):
     tour = get_object_or_404(Tour, slug=slug)
     # TODO: Think better how references will be managed.
     references = tour.references.all()
-    entries = tour.media.select_related('location', 'city', 'state', 'country')
+    entries = tour.media.select_related('location', 'city', 'state', 'country').prefetch_related(
+            'taxon_set')
 
     # Get first thumbnail.
     try:
@@ -402,18 +444,14 @@ def tour_page(request, slug):
     except:
         thumb = ''
 
-    # Extract media metadata.
-    # TODO: Do I really need to get all of these?
-    authors, taxa, locations, cities, states, countries, tags = extract_set(entries)
-    # Only using authors/taxa/tags for meta keywords.
+    # Extract media metadata used by the template (on demand).
+    metadata = MediaMetadata(entries, 'authors', 'taxa', 'tags')
 
     context = {
         'tour': tour,
         'entries': entries,
         'thumb': thumb,
-        'authors': authors,
-        'taxa': taxa,
-        'tags': tags,
+        'metadata': metadata,
         'references': references,
         }
 
@@ -421,25 +459,33 @@ def tour_page(request, slug):
 
 
 # Menu
+@cache_control(max_age=0)
 def taxa_page(request):
     '''Taxa organized in a tree and species list.
 
-    Species list is a genus list to show undefined species as well.
+    Species list is a genus list to show undefined species as well. Only taxa
+    with public media are listed, counted by TaxonStats.
     '''
-    genera = Taxon.objects.filter(rank_en='Genus').order_by('name')
+    public = Q(stats__clade_photos__gt=0) | Q(stats__clade_videos__gt=0)
+    species = Taxon.objects.filter(public).select_related('stats').order_by('name')
+    genera = Taxon.objects.filter(public, rank_en='Genus').select_related(
+            'stats').order_by('name').prefetch_related(Prefetch('children', queryset=species))
     context = {
+        'versions': cache_versions('taxonomy'),
         'genera': genera,
         }
     return render(request, 'taxa_page.html', context)
 
 
+@cache_control(max_age=0)
 def places_page(request):
     '''Página mostrando locais de maneira organizada.'''
-    locations = Location.objects.order_by('name')
-    cities = City.objects.order_by('name')
-    states = State.objects.order_by('name')
-    countries = Country.objects.order_by('name')
+    locations = with_media_counts(Location.objects.order_by('name'))
+    cities = with_media_counts(City.objects.order_by('name'))
+    states = with_media_counts(State.objects.order_by('name'))
+    countries = with_media_counts(Country.objects.order_by('name'))
     context = {
+        'versions': cache_versions('location', 'city', 'state', 'country'),
         'locations': locations,
         'cities': cities,
         'states': states,
@@ -448,39 +494,50 @@ def places_page(request):
     return render(request, 'places_page.html', context)
 
 
+@cache_control(max_age=0)
 def tags_page(request):
     '''Página mostrando tags organizados por categoria.'''
-    cats = Category.objects.prefetch_related('tags')
+    cats = Category.objects.prefetch_related(
+            Prefetch('tags', queryset=with_media_counts(Tag.objects.all())))
     context = {
+        'versions': cache_versions('tag', 'category'),
         'cats': cats,
         }
     return render(request, 'tags_page.html', context)
 
 
+@cache_control(max_age=0)
 def authors_page(request):
     '''Página mostrando autores e especialistas.'''
-    authors = Person.objects.filter(is_author=True).order_by('name')
-    sources = Person.objects.filter(is_author=False).order_by('name')
+    authors = with_media_counts(Person.objects.filter(is_author=True).order_by('name'))
+    sources = with_media_counts(Person.objects.filter(is_author=False).order_by('name'))
     context = {
+        'versions': cache_versions('person'),
         'authors': authors,
         'sources': sources,
         }
     return render(request, 'authors_page.html', context)
 
 
+@cache_control(max_age=0)
 def refs_page(request):
     '''Página mostrando referências.'''
     references = Reference.objects.order_by('-citation')
     context = {
+        'versions': cache_versions('reference'),
+        'thumbs': SimpleLazyObject(lambda: thumbnail_pool('reference')),
         'references': references,
         }
     return render(request, 'refs_page.html', context)
 
 
+@cache_control(max_age=0)
 def tours_page(request):
     '''Página mostrando lista de tours disponíveis.'''
     tours = Tour.objects.order_by('-pub_date')
     context = {
+        'versions': cache_versions('tour'),
+        'thumbs': SimpleLazyObject(lambda: thumbnail_pool('tour')),
         'tours': tours,
         }
     return render(request, 'tours_page.html', context)
@@ -489,11 +546,11 @@ def tours_page(request):
 def press_page(request):
     '''Página com kit imprensa, texto melhores imagens.'''
     # Fotos
-    photos = Media.objects.filter(highlight=True, is_public=True, datatype='photo').order_by('?')
+    photos = Media.objects.filter(highlight=True, is_public=True, datatype='photo').random(9)
     cover_photo = photos[0]
-    photos = photos.exclude(id=cover_photo.id)[:8]
+    photos = photos[1:]
     # Videos
-    videos = Media.objects.filter(highlight=True, is_public=True, datatype='video').order_by('?')[:8]
+    videos = Media.objects.filter(highlight=True, is_public=True, datatype='video').random(8)
     context = {
         'photos': photos,
         'videos': videos,
@@ -514,14 +571,35 @@ def catch_get(keys, get):
         False
 
 
-def get_paginated(query_dict, media_list, n_page=16):
-    '''Return queryset paginator. n_page must be integer.'''
-    paginator = Paginator(media_list, n_page)
+def get_paginated(query_dict, media_list, n_page=16, keys=None, count=None, pivot=None,
+                  paginator=None):
+    '''Return queryset paginator. n_page must be integer.
+
+    If the sort keys of media_list are given, pages are fetched by keyset
+    from the after/before cursors in query_dict (see KeysetPaginator). With a
+    pivot, media are walked in random order from that point of the random key
+    (see ShuffledPaginator). A known count of media_list avoids the
+    paginator's COUNT query. A keyset paginator may also be given.
+    '''
     # Make sure page request is an int. If not, deliver first page.
     try:
         page = int(query_dict.get('page', '1'))
     except ValueError:
         page = 1
+    if paginator is None and pivot is not None:
+        paginator = ShuffledPaginator(media_list, n_page, pivot, count)
+    elif paginator is None and keys:
+        paginator = KeysetPaginator(media_list, n_page, keys, count)
+    if paginator:
+        try:
+            return paginator.page(max(page, 1), query_dict.get('after'),
+                                  query_dict.get('before'))
+        except ValueError:
+            # Invalid cursor, deliver first page.
+            return paginator.page()
+    paginator = Paginator(media_list, n_page)
+    if count is not None:
+        paginator.count = count
     # If page request (9999) is out of range, deliver last page of results.
     try:
         media_page = paginator.page(page)
@@ -530,21 +608,347 @@ def get_paginated(query_dict, media_list, n_page=16):
     return media_page
 
 
-def extract_set(media_list):
-    '''Extract other metadata from media list.
+def with_media_counts(queryset):
+    '''Annotate public photo and video counts of metadata items.
 
-    Returns invididual querysets for each model.
+    Counts come from a single grouped query; items without public media are
+    excluded.
     '''
+    public = Q(media__is_public=True)
+    return queryset.annotate(
+            photo_count=Count('media', filter=public & Q(media__datatype='photo')),
+            video_count=Count('media', filter=public & Q(media__datatype='video')),
+            ).annotate(media_count=F('photo_count') + F('video_count')).filter(media_count__gt=0)
 
-    authors = Person.objects.filter(id__in=media_list.values_list('person', flat=True))
-    tags = Tag.objects.filter(id__in=media_list.values_list('tag', flat=True))
-    taxa = Taxon.objects.filter(id__in=media_list.values_list('taxon', flat=True))
-    locations = Location.objects.filter(id__in=media_list.values_list('location', flat=True))
-    cities = City.objects.filter(id__in=media_list.values_list('city', flat=True))
-    states = State.objects.filter(id__in=media_list.values_list('state', flat=True))
-    countries = Country.objects.filter(id__in=media_list.values_list('country', flat=True))
 
-    return authors, taxa, locations, cities, states, countries, tags
+def filter_key(query_dict):
+    '''Return cache key suffix for the filters of a search.
+
+    Parameters that do not change the results are ignored and the key
+    includes the media version (see bump_cache_version).
+    '''
+    filters = sorted((key, sorted(str(value) for value in query_dict.getlist(key)))
+                     for key in query_dict if key not in COUNT_IGNORED)
+    digest = md5(json.dumps(filters).encode()).hexdigest()
+    return '{}:{}'.format(cache_version('media'), digest)
+
+
+def count_media(query_dict, media_list):
+    '''Return the number of results of a search, cached per filter set.
+
+    Large result sets use the planner's estimate instead of an exact count.
+    '''
+    key = 'count:' + filter_key(query_dict)
+    count = cache.get(key)
+    if count is None:
+        count = estimate_count(media_list)
+        if count < COUNT_ESTIMATE_THRESHOLD:
+            count = media_list.count()
+        cache.set(key, count)
+    return count
+
+
+def facet_counts(query_dict, media_list, operator):
+    '''Return number of results for each value of the sidebar facets.
+
+    media_list is not filtered by metadata yet. Returns a dictionary of
+    {id: count} for each form field in FACET_FIELDS, computed with one grouped
+    query per facet and cached per filter set.
+
+    With the 'or' operator the facets are disjunctive: the values of a field
+    are counted without the filter of that field, so the values that would
+    widen the results keep their counts.
+    '''
+    key = 'facets:' + filter_key(query_dict)
+    facets = cache.get(key)
+    if facets is None:
+        facets = {}
+        for param, field in FACET_FIELDS:
+            exclude = param if operator == 'or' else None
+            filtered = media_list.filter(
+                    compile_filters(query_dict, operator, exclude)).order_by()
+            if field in ('location', 'city', 'state', 'country'):
+                counts = filtered.filter(**{'{}__isnull'.format(field): False}).values(field)
+            else:
+                through = Media._meta.get_field(field).through
+                counts = through.objects.filter(media__in=filtered.values('id')).values(field)
+            counts = counts.annotate(n=Count('id')).values_list(field, 'n').order_by()
+            facets[param] = dict(counts)
+        cache.set(key, facets)
+    return facets
+
+
+def estimate_count(queryset):
+    '''Return the number of rows of a queryset estimated by the planner.'''
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPaginator:
+    '''Paginates a queryset by its sort keys instead of an offset.
+
+    keys is the ordering of the queryset (field or annotation names, with a
+    leading '-' for descending order) and must end in a unique field. A page is
+    fetched with a condition on the keys of the last item of the previous page
+    (or the first item of the next one), so deep pages cost the same as the
+    first. The total count may be given (cached or estimated).
+    '''
+
+    def __init__(self, object_list, per_page, keys, count=None):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.keys = keys
+        if count is not None:
+            self.count = count
+
+    @cached_property
+    def count(self):
+        return self.object_list.count()
+
+    @cached_property
+    def num_pages(self):
+        return max(1, ceil(self.count / self.per_page))
+
+    def encode(self, obj):
+        '''Return cursor with the key values of an item.'''
+        values = [getattr(obj, key.lstrip('-')) for key in self.keys]
+        cursor = urlsafe_b64encode(json.dumps(values, default=str).encode())
+        return cursor.decode().rstrip('=')
+
+    def decode(self, cursor):
+        '''Return key values from a cursor. Raises ValueError if invalid.'''
+        try:
+            values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (TypeError, binascii.Error, UnicodeDecodeError):
+            raise ValueError('Invalid cursor: {}'.format(cursor))
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            raise ValueError('Invalid cursor: {}'.format(cursor))
+        model = self.object_list.model
+        decoded = []
+        for key, value in zip(self.keys, values):
+            try:
+                field = model._meta.get_field(key.lstrip('-'))
+                decoded.append(field.to_python(value))
+            except FieldDoesNotExist:
+                # Annotations used as keys are integers.
+                try:
+                    decoded.append(int(value))
+                except TypeError:
+                    raise ValueError('Invalid cursor: {}'.format(cursor))
+            except ValidationError:
+                raise ValueError('Invalid cursor: {}'.format(cursor))
+        return decoded
+
+    def seek(self, values, backward=False):
+        '''Return condition for items after (or before) the key values.'''
+        query = Q()
+        for i, key in enumerate(self.keys):
+            descending = key.startswith('-') != backward
+            lookup = '{}__{}'.format(key.lstrip('-'), 'lt' if descending else 'gt')
+            condition = Q(**{lookup: values[i]})
+            for previous, value in zip(self.keys[:i], values):
+                condition &= Q(**{previous.lstrip('-'): value})
+            query |= condition
+        return query
+
+    def page(self, number=1, after=None, before=None):
+        '''Return the page after or before a cursor.
+
+        Without cursors the page number is fetched by offset, once, up to the
+        last page.
+        '''
+        size = self.per_page
+        if before:
+            ordering = [key[1:] if key.startswith('-') else '-' + key
+                        for key in self.keys]
+            queryset = self.object_list.filter(
+                    self.seek(self.decode(before), backward=True))
+            items = list(queryset.order_by(*ordering)[:size + 1])
+            has_previous = len(items) > size
+            items = items[:size][::-1]
+            has_next = True
+        else:
+            queryset = self.object_list
+            start = 0
+            if after:
+                queryset = queryset.filter(self.seek(self.decode(after)))
+            else:
+                # If page request (9999) is out of range, deliver last page.
+                number = min(number, self.num_pages)
+                start = (number - 1) * size
+            items = list(queryset[start:start + size + 1])
+            has_next = len(items) > size
+            items = items[:size]
+            has_previous = number > 1
+        if not has_previous:
+            number = 1
+        return KeysetPage(items, number, self, has_previous, has_next)
+
+
+class ShuffledPaginator(KeysetPaginator):
+    '''Paginates media in random order, starting from a pivot.
+
+    Media are walked in two ranges of the random key index, from the pivot to
+    the end and then from the start to the pivot. Pages are fetched by keyset
+    on (random_key, id) within the range of the cursor, so every page is a
+    range scan of the index. The range of a cursor follows from its random key.
+    '''
+
+    def __init__(self, object_list, per_page, pivot, count=None):
+        super().__init__(object_list, per_page, ['random_key', 'id'], count)
+        self.pivot = pivot
+        self.ranges = [object_list.filter(random_key__gte=pivot),
+                       object_list.filter(random_key__lt=pivot)]
+
+    def walk(self, values=None, backward=False, start=0, size=None):
+        '''Return up to size items from the cursor values (or an offset).'''
+        ordering = ['-random_key', '-id'] if backward else ['random_key', 'id']
+        first = 0
+        if values:
+            first = 0 if values[0] >= self.pivot else 1
+        ranges = [0, 1][first::-1] if backward else [0, 1][first:]
+        items = []
+        for i in ranges:
+            queryset = self.ranges[i].order_by(*ordering)
+            if values and i == first:
+                bound = 'random_key__lte' if backward else 'random_key__gte'
+                queryset = queryset.filter(Q(**{bound: values[0]}),
+                                           self.seek(values, backward))
+            if start:
+                part = list(queryset[start:start + size - len(items)])
+                start = 0 if part else start - queryset.count()
+            else:
+                part = list(queryset[:size - len(items)])
+            items.extend(part)
+            if len(items) >= size:
+                break
+        return items
+
+    def page(self, number=1, after=None, before=None):
+        '''Return the page after or before a cursor.
+
+        Without cursors the page number is fetched by offset, once, up to the
+        last page.
+        '''
+        size = self.per_page
+        if before:
+            items = self.walk(self.decode(before), backward=True, size=size + 1)
+            has_previous = len(items) > size
+            items = items[:size][::-1]
+            has_next = True
+        else:
+            values = self.decode(after) if after else None
+            if not after:
+                # If page request (9999) is out of range, deliver last page.
+                number = min(number, self.num_pages)
+            start = 0 if after else (number - 1) * size
+            items = self.walk(values, start=start, size=size + 1)
+            has_next = len(items) > size
+            items = items[:size]
+            has_previous = number > 1
+        if not has_previous:
+            number = 1
+        return KeysetPage(items, number, self, has_previous, has_next)
+
+
+class IndexShuffledPaginator(ShuffledPaginator):
+    '''ShuffledPaginator picking the media of a page from the media index.
+
+    The index walks the filtered ids in the same order, so only the media of
+    the page are fetched, by id.
+    '''
+
+    def __init__(self, object_list, per_page, pivot, index, ids):
+        super().__init__(object_list, per_page, pivot, index.count(ids))
+        self.index = index
+        self.ids = ids
+
+    def walk(self, values=None, backward=False, start=0, size=None):
+        '''Return up to size items from the cursor values (or an offset).'''
+        ids = self.index.walk(self.ids, self.pivot, values, backward, start, size)
+        media = self.object_list.in_bulk(ids)
+        return [media[id] for id in ids if id in media]
+
+
+class KeysetPage:
+    '''Page of a KeysetPaginator, with the interface of Django's Page.'''
+
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __repr__(self):
+        return '<Page {}>'.format(self.number)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return max(self.number - 1, 1)
+
+    @property
+    def next_cursor(self):
+        '''Query string parameter pointing to the next page.'''
+        if self._has_next and self.object_list:
+            return 'after=' + self.paginator.encode(self.object_list[-1])
+        return ''
+
+    @property
+    def previous_cursor(self):
+        '''Query string parameter pointing to the previous page.'''
+        if self._has_previous and self.object_list:
+            return 'before=' + self.paginator.encode(self.object_list[0])
+        return ''
+
+
+class MediaMetadata:
+    '''Metadata of a media list, extracted on first access.
+
+    Only the requested facets (e.g., 'authors', 'tags') are extracted. Each
+    facet is a queryset of its model filtered by a subquery over the media,
+    so it runs as a single query, only when the template reads it.
+    '''
+    FACETS = {
+        'authors': ('person', Person),
+        'taxa': ('taxon', Taxon),
+        'tags': ('tag', Tag),
+        'locations': ('location', Location),
+        'cities': ('city', City),
+        'states': ('state', State),
+        'countries': ('country', Country),
+        }
+
+    def __init__(self, media_list, *facets):
+        self.media_list = media_list
+        self.facets = facets
+
+    def __getattr__(self, name):
+        if name not in self.facets:
+            raise AttributeError(name)
+        field, model = self.FACETS[name]
+        objects = model.objects.filter(id__in=self.media_list.order_by().values(field))
+        setattr(self, name, objects)
+        return objects
 
 
 def add_meta(meta, field, query):
@@ -566,26 +970,61 @@ def add_meta(meta, field, query):
     return final_query
 
 
-def filter_request(media_list, objects, field, operator):
-    '''Filter media based on fields and operator.'''
+def compile_filters(query_dict, operator, exclude=None):
+    '''Return a single condition on media for the metadata in query_dict.
 
-    #TODO: Taxon descendants are not shown with AND operator.
+    Ids are used directly in subqueries, so no metadata is fetched and
+    the search runs as a single query. Fields are combined with AND, and
+    values within a field with the operator. The 'and' operator matches
+    many to many metadata with a HAVING COUNT over the through table.
+    Taxa also match their descendants. The exclude parameter is left out.
+    '''
+    condition = Q()
+    for param, field in FILTER_FIELDS:
+        if param == exclude:
+            continue
+        ids = set()
+        for value in query_dict.getlist(param):
+            try:
+                ids.add(int(value))
+            except ValueError:
+                continue
+        if ids:
+            condition &= field_filter(field, ids, operator)
+    return condition
+
+
+def field_filter(field, ids, operator):
+    '''Return condition on media for a set of ids of a metadata field.'''
+    if field in ('location', 'city', 'state', 'country'):
+        if operator == 'and':
+            return reduce(and_, [Q(**{field: id}) for id in ids])
+        return Q(**{'{}__in'.format(field): ids})
+
+    through = Media._meta.get_field(field).through.objects
+    if field == 'taxon':
+        subtrees = [taxon_subtree(id) for id in ids]
+        if operator == 'and':
+            return reduce(and_, [Q(id__in=through.filter(subtree).values('media'))
+                                 for subtree in subtrees])
+        return Q(id__in=through.filter(reduce(or_, subtrees)).values('media'))
+
+    media = through.filter(**{'{}__in'.format(field): ids}).values('media')
     if operator == 'and':
-        for obj in objects:
-            media_list = media_list.filter(**{field: obj})
-
-    elif operator == 'or':
-        queries = []
-        for obj in objects:
-            queries.append(Q(**{field: obj}))
-            if field == 'taxon':
-                children = obj.get_descendants()
-                for child in children:
-                    queries.append(Q(**{field: child}))
-
-        media_list = media_list.filter(reduce(or_, queries)).distinct()
-    
-    return media_list
+        media = media.annotate(n=Count(field, distinct=True)).filter(
+                n=len(ids)).values('media')
+    return Q(id__in=media)
+
+
+def taxon_subtree(id):
+    '''Return condition on taxon media links for a taxon and descendants.
+
+    Uses the MPTT interval of the taxon, read in scalar subqueries.
+    '''
+    taxon = Taxon.objects.filter(id=id).order_by()
+    return Q(taxon__tree_id=Subquery(taxon.values('tree_id')),
+             taxon__lft__gte=Subquery(taxon.values('lft')),
+             taxon__lft__lte=Subquery(taxon.values('rght')))
 
 
 def build_url(meta, field, queries, remove=False, append=None):
@@ -13,6 +13,8 @@ Usage:
 
 '''
 
+from collections import Counter, defaultdict
+from functools import partial
 from suds import null, WebFault
 from suds.client import Client
 import logging
@@ -29,6 +31,11 @@ console_handler.setLevel(logging.DEBUG)
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+
+class WormsError(Exception):
+    '''A call to the WoRMS web services failed after all attempts.'''
+
+
 class Aphia:
     '''Main WoRMS interactor.'''
     def __init__(self):
@@ -42,25 +49,36 @@ class Aphia:
         except:
             print('Could not connect to client!')
 
-    def wire(self, service, query, attempt=0):
-        '''Manage re-connections between client and WorMS.'''
-        try:
-            results = service(query)
-        except:
-            while attempt < 3:
-                logger.warning('Could not connect... try=%d' % attempt)
-                attempt += 1
-                self.wire(service, query, attempt)
-            logger.critical('Closing up the connection. I failed.')
-            results = None
-        return results
+    def wire(self, service, query, retries=3, strict=False):
+        '''Manage re-connections between client and WorMS.
+
+        Failed calls are retried. When all attempts fail returns None or, if
+        strict, raises WormsError, so a failure is not taken for no results.
+        '''
+        for attempt in range(retries + 1):
+            try:
+                return service(query)
+            except Exception as error:
+                logger.warning('Could not connect... try=%d (%s)', attempt, error)
+        logger.critical('Closing up the connection. I failed.')
+        if strict:
+            raise WormsError('Could not connect to WoRMS: {}'.format(query))
+        return None
 
     def get_best_match(self, query):
         '''Searches and finds best-matching valid WoRMS record.'''
         records = self.get_aphia_records(query)
         if not records:
-            # TODO Elaborate search with fuzzy match_aphia_records_by_names.
-            return None
+            # Fall back to fuzzy matching with TAXAMATCH.
+            results = self.match_aphia_records_by_names([query])
+            records = results[0] if results else None
+            if not records:
+                return None
+        return self.select_valid(records)
+
+    def select_valid(self, records):
+        '''Returns the accepted record or follows synonyms to the valid one.'''
+        valid = None
         for record in records:
             if record['status'] == 'accepted':
                 return record
@@ -68,6 +86,23 @@ class Aphia:
                 valid = self.get_best_match(record['valid_name'])
         return valid
 
+    def match_names(self, names, batch=50):
+        '''Fuzzy match a list of names and return their valid records.
+
+        Names are sent to matchAphiaRecordsByNames in batches (the service
+        accepts at most 50 names per call). Returns a dictionary with each
+        name and its valid record (or None).
+        '''
+        matches = {}
+        for i in range(0, len(names), batch):
+            chunk = names[i:i + batch]
+            results = self.match_aphia_records_by_names(chunk)
+            if not results:
+                continue
+            for name, records in zip(chunk, results):
+                matches[name] = self.select_valid(records) if records else None
+        return matches
+
     def get_aphia_id(self, query):
         '''Get the AphiaID for a given name.'''
         logger.info('Searching for the name "%s"', query)
@@ -154,17 +189,39 @@ class Aphia:
             )
         return results
 
-    def get_aphia_records_by_date(self, query):
-        '''Lists all AphiaRecords (taxa) modified or added between a specific time interval.'''
-        #TODO Define startdate parameters.
-        logger.info('Searching between dates "%s"', query)
+    def get_aphia_records_by_date(self, startdate, enddate='', offset=1):
+        '''Lists all AphiaRecords (taxa) modified or added between a specific time interval.
+
+        Dates are ISO 8601 strings. Returns at most 50 records per call, use
+        offset to page through the results. Raises WormsError if the service
+        fails, since a missing page cannot be told from the last one.
+        '''
+        logger.info('Searching between dates "%s" and "%s" (offset=%d)', startdate, enddate, offset)
 
         results = self.wire(
-            self.client.service.getAphiaRecordsByDate,
-            query
+            partial(self.client.service.getAphiaRecordsByDate,
+                    enddate=enddate, offset=offset),
+            startdate,
+            strict=True
             )
         return results
 
+    def iter_aphia_records_by_date(self, startdate, enddate=''):
+        '''Iterates over all AphiaRecords modified between two dates.
+
+        Stops after the last page; raises WormsError if a page fails.
+        '''
+        offset = 1
+        while True:
+            records = self.get_aphia_records_by_date(startdate, enddate, offset)
+            if not records:
+                break
+            for record in records:
+                yield record
+            if len(records) < 50:
+                break
+            offset += 50
+
     def get_aphia_classification_by_id(self, query):
         '''Get the complete classification for one taxon.
 
@@ -242,5 +299,89 @@ class Aphia:
             )
         return results
 
+class NameIndex:
+    '''Local trigram index of scientific names for fuzzy matching.
+
+    Used to resolve misspelled names against known taxa before asking WoRMS.
+    Similarity is the Dice coefficient between the trigram sets of two names.
+    '''
+    def __init__(self, names=(), cutoff=0.8):
+        self.cutoff = cutoff
+        self.names = {}
+        self.index = defaultdict(set)
+        self.update(names)
+
+    @staticmethod
+    def trigrams(name):
+        '''Returns the set of trigrams of a padded, lowercase name.'''
+        padded = '  {} '.format(' '.join(name.lower().split()))
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, name):
+        '''Adds a single name to the index.'''
+        if not name or name in self.names:
+            return
+        grams = self.trigrams(name)
+        self.names[name] = grams
+        for gram in grams:
+            self.index[gram].add(name)
+
+    def update(self, names):
+        '''Adds multiple names to the index.'''
+        for name in names:
+            self.add(name)
+
+    def candidates(self, query):
+        '''Returns known names above the cutoff, most similar first.'''
+        grams = self.trigrams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.index.get(gram, ()))
+        scores = []
+        for name, count in shared.items():
+            score = 2 * count / (len(grams) + len(self.names[name]))
+            if score >= self.cutoff:
+                scores.append((score, name))
+        return [name for score, name in sorted(scores, key=lambda item: (-item[0], item[1]))]
+
+    def match(self, query):
+        '''Returns the most similar known name or None if below cutoff.'''
+        if query in self.names:
+            return query
+        candidates = self.candidates(query)
+        return candidates[0] if candidates else None
+
+    def resolve(self, query):
+        '''Returns the only similar known name one typo away, or None.
+
+        Similar names farther apart may be other taxa (e.g., Bugulina and
+        Bugula), so these are not resolved.
+        '''
+        if query in self.names:
+            return query
+        near = [name for name in self.candidates(query) if one_edit(query, name)]
+        return near[0] if len(near) == 1 else None
+
+
+def one_edit(a, b):
+    '''Returns whether two names differ by a single typo.
+
+    Typos are one inserted, deleted or replaced letter or two swapped
+    adjacent letters, ignoring case.
+    '''
+    a, b = a.lower(), b.lower()
+    if a == b or abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    return a[i + 1:] == b[i + 1:] or (
+            a[i + 2:] == b[i + 2:] and a[i:i + 2] == b[i:i + 2][::-1])
+
+
 if __name__ == '__main__':
     print('Command line not yet implemented.')